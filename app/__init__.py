@@ -1,12 +1,18 @@
 # formerly __init__.py
+import os
 from flask import Flask
 from flask_cors import CORS
 
+# set to serve only the /checker routes (the /bkt routes, and pandas/numpy, are then never loaded)
+CHECKER_ONLY = os.environ.get("CHECKER_ONLY", "") == "true"
+
 app = Flask(__name__)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
 from app import routes
+if not CHECKER_ONLY:
+    from app import bkt_routes
 # import routes
 
 # if __name__ == "__main__":
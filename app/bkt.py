@@ -1,3 +1,4 @@
+import re
 import pandas as pd
 import numpy as np
 
@@ -17,6 +18,102 @@ STEP = 'step'
 CORRECT = 'correct'
 IS_READ = 'is_read'
 
+UNKNOWN_EID_MESSAGE = 'Given exercise ID not in response data. Return w/ no update. EID is {}'
+
+# learners x exercises scored at once by recommend_batch (bounds its memory use)
+BATCH_CHUNK_CELLS = 1 << 20
+
+
+class ItemParamStore:
+    """
+    Item parameters (eid, slip, guess, concept and optionally is_read) held in contiguous arrays
+    with an eid -> row index, so looking up one exercise's parameters is O(1) no matter how big
+    the item bank is. If an eid appears more than once, its first row is used (same as .iloc[0]).
+
+    Attributes
+    ----------
+    eids: list
+        exercise ids, one per row
+    slip, guess: np.ndarray (float)
+        slip and guess parameters, one per row
+    concepts: list
+        distinct concept names
+    concept_codes: np.ndarray (int)
+        index into concepts for each row
+    is_read: np.ndarray (bool) or None
+        is_read for each row, if the parameters had that column
+    index: dict
+        eid -> row
+    """
+
+    def __init__(self, eids, slip, guess, concepts, is_read=None):
+        self.eids = list(eids)
+        self.slip = np.asarray(slip, dtype=float)
+        self.guess = np.asarray(guess, dtype=float)
+        self.concepts = list(dict.fromkeys(concepts))
+        concept_index = {concept: code for code, concept in enumerate(self.concepts)}
+        self.concept_codes = np.array([concept_index[concept] for concept in concepts], dtype=int)
+        self.is_read = None if is_read is None else np.asarray(is_read, dtype=bool)
+        self.index = {}
+        for row, eid in enumerate(self.eids):
+            self.index.setdefault(eid, row)
+
+    @classmethod
+    def from_dataframe(cls, item_params):
+        """
+        item_params: pd.DataFrame with columns eid, slip, guess, concept (and optionally is_read)
+        """
+        is_read = item_params[IS_READ].values if IS_READ in item_params else None
+        return cls(item_params[EID].values, item_params[SLIP].values, item_params[GUESS].values,
+                   item_params[CONCEPT].values, is_read)
+
+    @classmethod
+    def from_records(cls, item_params):
+        """
+        item_params: list of dicts with keys eid, slip, guess, concept (and optionally is_read)
+        """
+        is_read = None
+        if len(item_params) > 0 and all(IS_READ in item for item in item_params):
+            is_read = [item[IS_READ] for item in item_params]
+        return cls([item[EID] for item in item_params],
+                   [item[SLIP] for item in item_params],
+                   [item[GUESS] for item in item_params],
+                   [item[CONCEPT] for item in item_params],
+                   is_read)
+
+    def __len__(self):
+        return len(self.eids)
+
+    def __contains__(self, eid):
+        return eid in self.index
+
+    def row(self, eid):
+        """
+        Row for eid, or None if it isn't in the store
+        """
+        return self.index.get(eid)
+
+    def rows(self, eids):
+        """
+        np.ndarray of rows for each eid in eids, -1 where an eid isn't in the store
+        """
+        return np.array([self.index.get(eid, -1) for eid in eids], dtype=int)
+
+    def concept(self, eid):
+        return self.concepts[self.concept_codes[self.index[eid]]]
+
+
+def as_item_param_store(item_params):
+    """
+    Returns item_params as an ItemParamStore. Accepts an ItemParamStore (returned as is), a
+    pd.DataFrame or a list of dicts (as sent in /bkt requests).
+    """
+    if isinstance(item_params, ItemParamStore):
+        return item_params
+    if isinstance(item_params, pd.DataFrame):
+        return ItemParamStore.from_dataframe(item_params)
+    return ItemParamStore.from_records(item_params)
+
 
 def posterior_pknown(is_correct, eid, transfer, item_params, prior_pknown):
     """
@@ -30,21 +127,22 @@ def posterior_pknown(is_correct, eid, transfer, item_params, prior_pknown):
         exercise ID
     transfer: float
         transfer probability for concept
-    item_params: pd.DataFrame
-        slip and guess parameters for each item
+    item_params: ItemParamStore (or pd.DataFrame)
+        slip and guess parameters for each item. Pass an ItemParamStore when calling repeatedly
     prior_pknown: float
         prior probability user learned this concept (read, write are different concepts)
     """
-    if not eid in item_params[EID].unique():
-        raise Exception(
-            'Given exercise ID not in response data. Return w/ no update. EID is {}'.format(eid))
+    item_params = as_item_param_store(item_params)
+    row = item_params.row(eid)
+    if row is None:
+        raise Exception(UNKNOWN_EID_MESSAGE.format(eid))
         return prior_pknown
 
     posterior = -1.0
 
-    # .iloc[0] added to get 1st one (just in case exercise ID duplicated to handle error condition where exercise is read & write)
-    slip = float(item_params[item_params[EID] == eid][SLIP].iloc[0]) 
-    guess = float(item_params[item_params[EID] == eid][GUESS].iloc[0])
+    # 1st row used if exercise ID duplicated (to handle error condition where exercise is read & write)
+    slip = float(item_params.slip[row])
+    guess = float(item_params.guess[row])
 
     if is_correct:
         posterior = (prior_pknown * (1.0 - slip)) / ((prior_pknown * (1 - slip)) + ((1.0-prior_pknown)*guess))
@@ -54,10 +152,51 @@ def posterior_pknown(is_correct, eid, transfer, item_params, prior_pknown):
     return (posterior + (1.0-posterior) * transfer)
 
 
+def posterior_pknown_batch(is_correct, eids, transfer, item_params, prior_pknown):
+    """
+    Vectorized posterior_pknown for many updates at once. Returns np.ndarray of posteriors, with
+    NaN for updates whose exercise ID isn't in item_params.
+
+    Parameters
+    ----------
+    is_correct: array-like (bool)
+    eids: list
+        exercise IDs
+    transfer: array-like (float) or float
+        transfer probability for each update's concept
+    item_params: ItemParamStore (or pd.DataFrame, list of dicts)
+    prior_pknown: array-like (float)
+    """
+    item_params = as_item_param_store(item_params)
+    rows = item_params.rows(eids)
+    known = rows >= 0
+    is_correct = np.asarray(is_correct, dtype=bool)
+    prior_pknown = np.asarray(prior_pknown, dtype=float)
+    transfer = np.broadcast_to(np.asarray(transfer, dtype=float), prior_pknown.shape)
+
+    slip = np.where(known, item_params.slip[rows], np.nan)
+    guess = np.where(known, item_params.guess[rows], np.nan)
+    return posterior_pknown_arrays(is_correct, slip, guess, transfer, prior_pknown)
+
+
+def posterior_pknown_arrays(is_correct, slip, guess, transfer, prior_pknown):
+    """
+    posterior_pknown on np.ndarrays of already looked up parameters (all of the same shape, or
+    broadcastable). Uses the same arithmetic as posterior_pknown, so results match it exactly.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        posterior = np.where(
+            is_correct,
+            (prior_pknown * (1.0 - slip)) / ((prior_pknown * (1 - slip)) + ((1.0-prior_pknown)*guess)),
+            (prior_pknown * slip) / ((prior_pknown * slip) + ((1.0-prior_pknown)*(1.0-guess))))
+    return posterior + (1.0-posterior) * transfer
+
+
 def pknown_seq(uid, concept, df_opp, concept_params, item_params, is_read=True):
     """
     Predict sequence of probability a concept is known after each step.
-    Function not used in real-time, but may be used to batch update pknown (e.g. if concept or exercise params updated)
+    Function not used in real-time, but may be used to batch update pknown (e.g. if concept or exercise params updated).
+    See replay.py to re-estimate every learner and concept at once.
     
     Parameters
     ----------
@@ -90,6 +229,7 @@ def pknown_seq(uid, concept, df_opp, concept_params, item_params, is_read=True):
     
     if(n_opps > 0):
         transfer = float(concept_params_target[TRANSFER])        
+        item_param_store = as_item_param_store(item_params)
         
         for step in range(1,n_opps+1):
             df_step = exercise_seq[exercise_seq[STEP]==step]
@@ -100,7 +240,7 @@ def pknown_seq(uid, concept, df_opp, concept_params, item_params, is_read=True):
             is_correct = df_step.iloc[0][CORRECT]
             eid = df_step.iloc[0][EID]
             
-            pk[step] = posterior_pknown(is_correct, eid, transfer, item_params, pk[step - 1])
+            pk[step] = posterior_pknown(is_correct, eid, transfer, item_param_store, pk[step - 1])
     return pk
 
 
@@ -134,21 +274,22 @@ def pcorrect_seq(uid, concept, df_opp, concept_params, item_params, is_read=True
     n_opps = len(exercise_seq) # number exercises attempted
 
     pk = pknown_seq(uid, concept, df_opp, concept_params, item_params, is_read)
+    item_param_store = as_item_param_store(item_params)
     pc = pd.Series(np.zeros(n_opps))
     for step in range(0,len(pc)):
-        eid = exercise_seq.iloc[step][EID]
-        slip = float(item_params[item_params[EID] == eid][SLIP])
-        guess = float(item_params[item_params[EID] == eid][GUESS])
-        pc[step] = pcorrect(pk[step], slip, guess)
+        row = item_param_store.row(exercise_seq.iloc[step][EID])
+        pc[step] = pcorrect(pk[step], item_param_store.slip[row], item_param_store.guess[row])
 
     return pc
 
 
-def order_next_questions(exercise_ids, pk, item_params, error = 0.0, penalty = 1.0):
+def order_next_questions(exercise_ids, pk, item_params, error = 0.0, penalty = 1.0, k = None):
     """
     Order questions based on "most answerable." 
     Exercise IDs and probability of known must be of same concept, either read or write.
-    Returns dataframe (col: {eid, score, diff, dist}) ordered by lowest distance (dist)
+    Returns dataframe (col: {eid, score, diff, dist}) ordered by lowest distance (dist).
+    Rows keep the index of their position in exercise_ids. Ties in dist are ordered as
+    DataFrame.sort_values(by='dist') orders them.
     
     Parameters
     ----------
@@ -156,27 +297,105 @@ def order_next_questions(exercise_ids, pk, item_params, error = 0.0, penalty = 1
         list of exercise ids (Strings) for same concept
     pk: float
         probability concept is known
-    item_params: pd.DataFrame
+    item_params: ItemParamStore (or pd.DataFrame, list of dicts)
         item parameters (eid, slip, guess, concept)
+    k: int
+        if given, only the first k rows are returned
     """
-    df_output = pd.DataFrame({"eid": exercise_ids, "score": np.zeros(len(exercise_ids))})
-    df_item_params = pd.DataFrame.from_dict(item_params)
-    
-    # get max and min scores/p(correct)
-    for eid in exercise_ids:
-        if eid in list(df_item_params[EID]):
-            params = df_item_params[df_item_params[EID] == eid].iloc[0]
-            df_output.loc[df_output[EID] == eid, 'score'] = pcorrect(pk, params[SLIP], params[GUESS])
+    order, score, diff, dist = rank_next_questions(exercise_ids, pk, item_params, error, penalty, k)
+    return pd.DataFrame({"eid": [exercise_ids[i] for i in order], "score": score,
+                         "diff": diff, "dist": dist}, index=order)
+#     return list(df_output.sort_values(by='diff')[EID])
+
 
-    min_score = min(df_output['score'])
-    max_score = max(df_output['score'])
+def rank_next_questions(exercise_ids, pk, item_params, error = 0.0, penalty = 1.0, k = None):
+    """
+    order_next_questions without the DataFrame: returns np.ndarrays (order, score, diff, dist),
+    where order is the positions in exercise_ids from lowest to highest dist and score, diff and
+    dist are in that order
+    """
+    item_params = as_item_param_store(item_params)
+    rows = item_params.rows(exercise_ids)
+    known = rows >= 0
+
+    # exercises without item params get a score of 0
+    scores = np.zeros(len(exercise_ids))
+    scores[known] = pcorrect(pk, item_params.slip[rows[known]], item_params.guess[rows[known]])
+
+    # get max and min scores/p(correct)
+    min_score = scores.min()
+    max_score = scores.max()
     target_score = min_score + ((max_score - min_score) * (1 - pk + error))
-    
-    df_output['diff'] = (target_score - df_output['score']) * penalty
-    df_output['dist'] = abs(df_output['diff'])
 
-    return df_output.sort_values(by = 'dist')    
-#     return list(df_output.sort_values(by='diff')[EID])
+    diff = (target_score - scores) * penalty
+    dist = np.abs(diff)
+    # the same (unstable) sort as sort_values(by='dist'), so tied exercises, and which of them make
+    # the NUM_TOP_RECS cut in /bkt, come out as they always have
+    order = np.argsort(dist, kind='quicksort')[:k]
+    return order, scores[order], diff[order], dist[order]
+
+class ConceptGraph:
+    """
+    A concept map ({concepts, adjMat}, see filter_ordered_questions_by_concepts) compiled for lookups:
+    concept -> index, and the parents and children of each concept as sets of concept names.
+    A concept isn't counted as its own parent or child.
+    """
+
+    def __init__(self, concept_map):
+        self.concepts = list(concept_map[CONCEPTS_STR])
+        self.index = {}
+        for idx, concept in enumerate(self.concepts):
+            self.index.setdefault(concept, idx) # same as list.index if a concept is repeated
+        self.children = [set() for _ in self.concepts]
+        self.parents = [set() for _ in self.concepts]
+        # adjMat[row][col] > 0 means col is a child of row
+        for row, col in concept_map_edges(concept_map[ADJ_MAT_STR]):
+            if row != col:
+                self.children[row].add(self.concepts[col])
+                self.parents[col].add(self.concepts[row])
+
+    def related(self, target):
+        """
+        Set of target and its parents and children
+        """
+        if target not in self.index:
+            raise ValueError("Concept {} is not in concept map".format(target))
+        target_index = self.index[target]
+        return {target} | self.children[target_index] | self.parents[target_index]
+
+
+# any byte but 0 (see concept_map_edges)
+_NONZERO_BYTE = re.compile(b"[^\x00]")
+
+
+def concept_map_edges(adj_mat):
+    """
+    (row, col) of every entry of adj_mat that is > 0, row by row. Rows of all 0s are skipped with
+    list.count, and rows of small non-negative ints (the usual 0/1 case) are searched as bytes, so
+    most of adj_mat is never gone through element by element in python.
+    """
+    edges = []
+    for row, values in enumerate(adj_mat):
+        if not isinstance(values, list):
+            values = list(values)
+        if values.count(0) == len(values):
+            continue
+        try:
+            edges.extend((row, match.start()) for match in _NONZERO_BYTE.finditer(bytes(values)))
+        except (TypeError, ValueError): # floats, negative or large values
+            edges.extend((row, col) for col, val in enumerate(values) if val > 0)
+    return edges
+
+
+def get_concept_graph(concept_map):
+    """
+    Returns concept_map compiled as a ConceptGraph. concept_map may also be a ConceptGraph already
+    (e.g. from a registered parameter set, see param_registry), which is then used as is.
+    """
+    if isinstance(concept_map, ConceptGraph):
+        return concept_map
+    return ConceptGraph(concept_map)
+
 
 # TODO: add consideration for sibblings
 def filter_ordered_questions_by_concepts(questions, item_params, target_concept, concept_map):
@@ -188,90 +407,96 @@ def filter_ordered_questions_by_concepts(questions, item_params, target_concept,
     ----------
     questions: list
         ordered list of exercise ids (strings) where index 0 is 1st (most recommended) exercise
-    item_params: pd.DataFrame
+    item_params: ItemParamStore (or pd.DataFrame, list of dicts)
         item parameters (eid, slip, guess, concept)
     target_concept: string
         
-    concept_map: dict
+    concept_map: dict (or ConceptGraph)
         dictionary with 2 attributes: {concepts, adjMat}. 
         adjMat is a list of lists which serves as an adjacency matrix for the concept map (directed graph)
         concepts is a list of concepts where a concept at index i maps to the same index on adjMat
     """ 
-    
-    def get_parents(target, concept_map):
-        """
-        Given a target concept, return a list of concept IDs for parent concepts
-        """
-        parents = []
-        target_index = concept_map[CONCEPTS_STR].index(target)
-        for row in range(len(concept_map[ADJ_MAT_STR])): 
-            # get value in adjMat for each row at target concept's col
-            val = concept_map[ADJ_MAT_STR][row][target_index] 
-            if val > 0 and target_index != row: # don't care concepts are their own parents
-                # print('parent found at {}, {}'.format(row, target_index)) # TODO remove
-                parents.append(concept_map[CONCEPTS_STR][row])
-        return parents
-
-    def get_children(target, concept_map):
-        """
-        Given a target concept, return a list of concept IDs for all child concepts
-        """
-        child_inds = []
-        target_index = concept_map[CONCEPTS_STR].index(target)
-        target_row = concept_map[ADJ_MAT_STR][target_index]
-        for ind in range(len(target_row)): # for each ind in row of adj mat
-            val = target_row[ind]
-            if(val>0 and ind != target_index): # don't care concept is child of itself
-                child_inds.append(ind)
-        return list(map(lambda ind: concept_map[CONCEPTS_STR][ind], child_inds))
-
-    def get_concept(eid, item_params):
-        """
-        Given a question/exercise eid (String) and item_params (pd.DataFrame),
-        return the concept that exercise corresponds to.
+    item_params = as_item_param_store(item_params)
+    questions = list(questions)
+    if len(questions) == 0:
+        return []
+    related = get_concept_graph(concept_map).related(target_concept)
+    # which of the item params' concept codes are related to target_concept
+    is_related = np.array([concept in related for concept in item_params.concepts], dtype=bool)
 
-        Assumes eid is unique (maps to exactly 1 row)
-        """
-
-        concept = item_params[item_params[EID]==eid][CONCEPT]
-
-        if len(concept) < 1: # TODO: make this filter "!= 1" to be more strict
+    rec_eids = []
+    for eid in questions:
+        row = item_params.row(eid)
+        if row is None:
             raise Exception("Exercise ID does not map to any exercises. eid: {}".format(eid))
-        else:
-            return concept.iloc[0] # to get actual value
-    
-    df_item_params = pd.DataFrame.from_dict(item_params)
+        if is_related[item_params.concept_codes[row]]:
+            rec_eids.append(eid)
 
-    rec_eids = []
+    # want order of recommendations to stay same
+    return rec_eids
 
-    # get all recommendations from target, its children, parents
-    rec_eids += list(filter(lambda q: get_concept(q, df_item_params) in 
-                          [target_concept] + 
-                          get_children(target_concept, concept_map) +
-                          get_parents(target_concept, concept_map), questions))
-    
-    # # GET TOP FOR EACH RELATIONSHIP
-    # # add max_num_target questions of same concept to rec_eids
-    # rec_target = list(filter(lambda q: get_concept(q, df_item_params) == target_concept, 
-    #                       questions))[:max_num_target]
-    # # print("For target, added {}".format(rec_target))
-    # rec_eids += rec_target
-                
-
-    # # add max_num_child questions of child concepts to rec_eids
-    # rec_child = list(filter(lambda q: get_concept(q, df_item_params) in get_children(target_concept, concept_map), 
-    #                       questions))[:max_num_child]
-    # # print("For children, added {}".format(rec_child ))
-    # rec_eids += rec_child
-
-    # # add max_num_parent questions of parent concepts to rec_eids
-    # rec_parent = list(filter(lambda q: get_concept(q, df_item_params) in get_parents(target_concept, concept_map), 
-    #                       questions))[:max_num_parent] 
-    # # print("For parents, added {}".format(rec_parent))
-    # rec_eids += rec_parent                             
-
-    # want order of recommendations to stay same & only grab from top half of recommendations
-    # return list(filter(lambda eid: eid in rec_eids, questions[:int(len(questions)/2)+1])) 
 
-    # want order of recommendations to stay same
-    return list(filter(lambda eid: eid in rec_eids, questions)) 
\ No newline at end of file
+def recommend_batch(exercise_ids, pks, item_params, target_concept, concept_map,
+                    num_top, num_related, error = 0.0, penalty = 1.0):
+    """
+    Recommendations for many learners at once, the same ones /bkt picks for each: the num_top
+    exercises of order_next_questions plus the top num_related exercises of related concepts
+    (filter_ordered_questions_by_concepts), in order. Returns a list of lists of exercise ids, one
+    per pk. Every exercise ID must be in item_params.
+
+    Parameters
+    ----------
+    exercise_ids: list
+        candidate exercise ids (Strings), shared by all learners
+    pks: array-like (float)
+        probability concept is known, one per learner
+    item_params: ItemParamStore (or pd.DataFrame, list of dicts)
+    target_concept: string
+    concept_map: dict (or ConceptGraph)
+    """
+    item_params = as_item_param_store(item_params)
+    pks = np.asarray(pks, dtype=float)
+    rows = item_params.rows(exercise_ids)
+    if (rows < 0).any():
+        raise Exception("Exercise ID does not map to any exercises. eid: {}".format(
+            exercise_ids[int(np.argmax(rows < 0))]))
+    if len(exercise_ids) == 0:
+        return [[] for _ in pks]
+
+    related_concepts = get_concept_graph(concept_map).related(target_concept)
+    is_related_code = np.array([concept in related_concepts for concept in item_params.concepts], dtype=bool)
+    is_related = is_related_code[item_params.concept_codes[rows]]
+    slip = item_params.slip[rows]
+    guess = item_params.guess[rows]
+    eids = np.array(exercise_ids, dtype=object)
+    # duplicated exercise ids share a code, since recommendations are picked by id
+    _, eid_codes = np.unique(eids.astype(str), return_inverse=True)
+    num_codes = eid_codes.max() + 1
+
+    recommendations = []
+    chunk_size = max(1, BATCH_CHUNK_CELLS // len(exercise_ids))
+    for start in range(0, len(pks), chunk_size):
+        pk = pks[start:start + chunk_size, np.newaxis]
+
+        # order_next_questions for every learner in the chunk (one row each)
+        scores = pcorrect(pk, slip, guess)
+        target_score = scores.min(axis=1, keepdims=True) + \
+            ((scores.max(axis=1, keepdims=True) - scores.min(axis=1, keepdims=True)) * (1 - pk + error))
+        dist = np.abs((target_score - scores) * penalty)
+        order = np.argsort(dist, axis=1, kind='quicksort') # as rank_next_questions
+        ordered_codes = eid_codes[order]
+
+        # top num_top overall plus the top num_related of related concepts
+        ordered_related = is_related[order]
+        related_rank = np.cumsum(ordered_related, axis=1)
+        picked = np.zeros((len(pk), num_codes), dtype=bool)
+        learners = np.arange(len(pk))[:, np.newaxis]
+        picked[learners, ordered_codes[:, :num_top]] = True
+        picked_related = ordered_related & (related_rank <= num_related)
+        picked[np.nonzero(picked_related)[0], ordered_codes[picked_related]] = True
+
+        # every candidate with a recommended id, in order (like df_ordered[EID].isin(rec_eids))
+        recommended = picked[learners, ordered_codes]
+        for learner in range(len(pk)):
+            recommendations.append(eids[order[learner][recommended[learner]]].tolist())
+    return recommendations
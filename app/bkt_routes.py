@@ -0,0 +1,386 @@
+"""
+Routes for Bayesian Knowledge Tracing (/bkt). The BKT modules need pandas and numpy, which take
+a while to import and use a fair amount of memory. They are only imported when a /bkt request
+first arrives, so workers that only grade /checker requests never load them. With CHECKER_ONLY
+set, these routes aren't registered at all (see app/__init__.py).
+"""
+from app import app
+from flask import request, Response
+import json
+from flask_cors import cross_origin
+from .routes import JSON_TYPE, TEXT_TYPE, EID, BATCH, is_req_not_json_type
+from . import metrics
+
+PARAMS = "params"
+LEARNERS = "learners"
+
+
+@app.route("/bkt", methods=["POST"])
+@cross_origin()
+def bkt_handler(NUM_TOP_RECS=2, NUM_RELATED_RECS=2):
+    """
+    NUM_TOP_RECS: Number of recommendations
+    NUM_RELATED_RECS: Number of recommendations to get from related concepts (from target, its child or parents)
+    """
+    from .bkt import (posterior_pknown, order_next_questions, filter_ordered_questions_by_concepts,
+                      UNKNOWN_EID_MESSAGE)
+    from .learner_state import learner_states
+
+    # Make sure is POST request
+    if request.method != "POST":
+        resp = Response("Must be a POST request",
+                        status=405, mimetype=TEXT_TYPE)
+        return resp
+
+    # Make sure is JSON request body
+    if is_req_not_json_type(request):
+        resp = Response("Request body must be JSON",
+                        status=415, mimetype=TEXT_TYPE)
+        return resp
+
+    # get request body
+    with metrics.timed("parse"):
+        req_body = request.get_json()
+
+    # 1: exerciseInfo is a JSON string (DataFrame.to_json), 2: exerciseInfo is an object of arrays
+    response_version = req_body.get("responseVersion", request.args.get("responseVersion", 1))
+    if str(response_version) not in ("1", "2"):
+        resp = Response("responseVersion must be 1 or 2",
+                        status=400, mimetype=TEXT_TYPE)
+        return resp
+    response_version = int(response_version)
+
+    is_correct = req_body.get("isCorrect", None)
+    read_or_write = req_body.get("readOrWrite", None)
+    eid = req_body.get("exerciseID", None)
+    transfer = req_body.get("transfer", None)
+    target_concept = req_body.get("targetConcept", None)
+
+    with metrics.timed("item_params"):
+        item_param_store, concept_map, error_resp = get_bkt_params(req_body)
+    if error_resp is not None:
+        return error_resp
+    prior_pknown = req_body.get("priorPknown", None)
+    exercise_ids = req_body.get("exerciseIDs", None)
+    # with a uid, the prior can come from (and the new estimate is saved to) the learner state store
+    uid = req_body.get("uid", None)
+    use_learner_state = (uid is not None) and (learner_states is not None)
+
+    if (is_correct is None) or (eid is None) \
+            or (transfer is None) or (item_param_store is None) \
+            or ((prior_pknown is None) and not use_learner_state) or (exercise_ids is None) \
+            or (read_or_write is None) or (concept_map is None) \
+            or (target_concept is None):
+        resp = Response("You are missing a field",
+                        status=400, mimetype=TEXT_TYPE)
+        return resp
+
+    def update_pknown(stored_pknown):
+        # a priorPknown sent by the client takes precedence over the stored one
+        prior = prior_pknown if prior_pknown is not None else stored_pknown
+        if prior is None:
+            raise ValueError("No stored pknown for learner {}, send priorPknown".format(uid))
+        return posterior_pknown(is_correct, eid, transfer, item_param_store, prior)
+
+    pk_new = None
+    try:
+        with metrics.timed("posterior"):
+            if eid not in item_param_store:
+                # checked before the learner's stored estimate is looked up, so the error is about the eid
+                raise Exception(UNKNOWN_EID_MESSAGE.format(eid))
+            if use_learner_state:
+                # read and write read_or_write's estimate for the concept of the answered exercise
+                pk_new = learner_states.update(str(uid), item_param_store.concept(eid), bool(read_or_write),
+                                               update_pknown)
+            else:
+                pk_new = update_pknown(None)
+    except Exception as exc:
+        resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
+        return resp
+
+    if response_version == 2:
+        results = bkt_response_v2(pk_new, exercise_ids, item_param_store, target_concept, concept_map,
+                                  NUM_TOP_RECS, NUM_RELATED_RECS)
+        with metrics.timed("encode"):
+            return Response(json.dumps(results), status=200, mimetype=JSON_TYPE)
+
+    # TODO: This may be returned as an un-serializable object (Series), will have to
+    # call a function to convert to list if so
+    with metrics.timed("order"):
+        df_ordered = order_next_questions(exercise_ids, pk_new, item_param_store)
+    
+    # get eids for exercises to recommend (getting recommendations based on hierarchical relationship)
+    with metrics.timed("concept_filter"):
+        eid_related = filter_ordered_questions_by_concepts(df_ordered[EID], item_param_store, target_concept, concept_map)
+    eid_top_n = df_ordered.reset_index().iloc[range(0,NUM_TOP_RECS), :] # get top recs overall
+
+    rec_eids = list(eid_top_n[EID]) + eid_related[0:NUM_RELATED_RECS] # merge list of eids that are top N, top N related to concept
+    rec_eids = list(dict.fromkeys(rec_eids)) # remove duplicates
+    
+    df_ordered = df_ordered[df_ordered[EID].isin(rec_eids)]
+
+    with metrics.timed("encode"):
+        results = {
+            "pkNew": pk_new,
+            "exerciseInfo": df_ordered.reset_index().to_json(),
+            "suggestedExercises": list(df_ordered[EID]) # don't actually need to pass this (b/c included in exerciseInfo), but convinent & reverse-compatiable
+        }
+        resp = Response(json.dumps(results), status=200, mimetype=JSON_TYPE)
+    # print("pk changed from {} to {} (change of {})".format(prior_pknown, pk_new, (pk_new - prior_pknown))) # TODO remove
+    return resp
+
+
+def bkt_response_v2(pk_new, exercise_ids, item_param_store, target_concept, concept_map,
+                    NUM_TOP_RECS, NUM_RELATED_RECS):
+    """
+    /bkt response body with responseVersion 2. Same recommendations as version 1, but exerciseInfo
+    is an object of arrays rather than a JSON string, so the response is encoded (and decoded) once:
+        {
+            responseVersion: 2,
+            pkNew: float,
+            exerciseInfo: {index: [int], eid: [string], score: [float], diff: [float], dist: [float]},
+            suggestedExercises: [string]
+        }
+    index is each exercise's position in exerciseIDs; full float precision is kept.
+    """
+    from .bkt import rank_next_questions, filter_ordered_questions_by_concepts
+
+    with metrics.timed("order"):
+        order, score, diff, dist = rank_next_questions(exercise_ids, pk_new, item_param_store)
+        ordered_eids = [exercise_ids[i] for i in order]
+
+    # get eids for exercises to recommend (getting recommendations based on hierarchical relationship)
+    with metrics.timed("concept_filter"):
+        eid_related = filter_ordered_questions_by_concepts(ordered_eids, item_param_store, target_concept, concept_map)
+    rec_eids = set(ordered_eids[0:NUM_TOP_RECS] + eid_related[0:NUM_RELATED_RECS])
+    keep = [pos for pos, eid in enumerate(ordered_eids) if eid in rec_eids]
+
+    suggested = [ordered_eids[pos] for pos in keep]
+    return {
+        "responseVersion": 2,
+        "pkNew": pk_new,
+        "exerciseInfo": {
+            "index": order[keep].tolist(),
+            EID: suggested,
+            "score": score[keep].tolist(),
+            "diff": diff[keep].tolist(),
+            "dist": dist[keep].tolist()
+        },
+        "suggestedExercises": suggested
+    }
+
+
+@app.route(f"/bkt/{BATCH}", methods=["POST"])
+@cross_origin()
+def bkt_batch_handler(NUM_TOP_RECS=2, NUM_RELATED_RECS=2):
+    """
+    Updates knowledge estimates for many (learner, exercise, correctness) tuples in one request.
+    Request body:
+        {
+            isCorrect: [boolean],
+            exerciseID: [string],
+            priorPknown: [float],
+            transfer: [float] or float (same for every update),
+            itemParams, conceptMap or paramsVersion: same as /bkt,
+            exerciseIDs: [string] (optional, candidates to recommend from, same as /bkt),
+            targetConcept: string (required with exerciseIDs)
+        }
+    Responds with {"results": [...]}, one per update in input order: {"pkNew": float} plus
+    "suggestedExercises" (same as /bkt) if exerciseIDs was sent, or {"error": string} if the update's
+    exerciseID has no item params.
+    """
+    import numpy as np
+    from .bkt import posterior_pknown_batch, recommend_batch
+
+    if is_req_not_json_type(request):
+        resp = Response("Request body must be JSON",
+                        status=415, mimetype=TEXT_TYPE)
+        return resp
+
+    with metrics.timed("parse"):
+        req_body = request.get_json()
+    is_correct = req_body.get("isCorrect", None)
+    eids = req_body.get("exerciseID", None)
+    prior_pknown = req_body.get("priorPknown", None)
+    transfer = req_body.get("transfer", None)
+    exercise_ids = req_body.get("exerciseIDs", None)
+    target_concept = req_body.get("targetConcept", None)
+
+    if (is_correct is None) or (eids is None) or (prior_pknown is None) or (transfer is None) \
+            or ((exercise_ids is not None) and (target_concept is None)):
+        resp = Response("You are missing a field",
+                        status=400, mimetype=TEXT_TYPE)
+        return resp
+    arrays = [is_correct, eids, prior_pknown] + ([transfer] if isinstance(transfer, list) else [])
+    if not all(isinstance(array, list) and len(array) == len(eids) for array in arrays):
+        resp = Response("isCorrect, exerciseID, priorPknown (and transfer, if a list) must be lists of the same length",
+                        status=400, mimetype=TEXT_TYPE)
+        return resp
+
+    with metrics.timed("item_params"):
+        item_param_store, concept_map, error_resp = get_bkt_params(req_body)
+    if error_resp is not None:
+        return error_resp
+
+    try:
+        with metrics.timed("posterior"):
+            pk_new = posterior_pknown_batch(is_correct, eids, transfer, item_param_store, prior_pknown)
+    except (TypeError, ValueError, KeyError, IndexError) as exc:
+        resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
+        return resp
+    updated = ~np.isnan(pk_new)
+
+    suggested = None
+    if exercise_ids is not None:
+        try:
+            with metrics.timed("recommend"):
+                suggested = iter(recommend_batch(exercise_ids, pk_new[updated], item_param_store, target_concept,
+                                                 concept_map, NUM_TOP_RECS, NUM_RELATED_RECS))
+        except Exception as exc:
+            resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
+            return resp
+
+    results = []
+    for idx, pk in enumerate(pk_new.tolist()):
+        if not updated[idx]:
+            results.append({"error": "Given exercise ID not in response data. EID is {}".format(eids[idx])})
+            continue
+        result = {"pkNew": pk}
+        if suggested is not None:
+            result["suggestedExercises"] = next(suggested)
+        results.append(result)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps({"results": results}), status=200, mimetype=JSON_TYPE)
+    return resp
+
+
+def get_bkt_params(req_body):
+    """
+    Returns (item_param_store, concept_map, None) for a /bkt request body, from its paramsVersion
+    or else its itemParams and conceptMap. Returns (None, None, error response) if they are invalid.
+    """
+    from .bkt import ItemParamStore
+    from .param_registry import registry as param_registry
+
+    params_version = req_body.get("paramsVersion", None)
+    if params_version is not None:
+        # item params and concept map were uploaded earlier (see params_upload_handler)
+        param_set = param_registry.get(str(params_version))
+        if param_set is None:
+            resp = Response(f"Unknown paramsVersion {params_version}",
+                            status=404, mimetype=TEXT_TYPE)
+            return None, None, resp
+        return param_set.item_param_store, param_set.concept_graph, None
+
+    try:
+        # index item params once so lookups don't scan the whole item bank
+        item_param_store = ItemParamStore.from_dataframe(
+            convert_item_params_to_dataframe(req_body.get("itemParams", None)))
+    except Exception as exc:
+        resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
+        return None, None, resp
+    return item_param_store, req_body.get("conceptMap", None), None
+
+
+@app.route(f"/bkt/{LEARNERS}/<uid>", methods=["GET"])
+@cross_origin()
+def learner_state_handler(uid):
+    """
+    Returns a learner's stored knowledge estimates:
+        {"uid": string, "mastery": [{"concept": string, "isRead": boolean, "pknown": float}]}
+    """
+    from .learner_state import learner_states
+
+    if learner_states is None:
+        resp = Response("Learner state store is not enabled (set LEARNER_STATE_DIR)",
+                        status=404, mimetype=TEXT_TYPE)
+        return resp
+    mastery = learner_states.learner(uid)
+    if mastery is None:
+        resp = Response(f"Unknown learner {uid}", status=404, mimetype=TEXT_TYPE)
+        return resp
+    body = {
+        "uid": uid,
+        "mastery": [{"concept": concept, "isRead": is_read, "pknown": pknown}
+                    for (concept, is_read), pknown in sorted(mastery.items())]
+    }
+    return Response(json.dumps(body), status=200, mimetype=JSON_TYPE)
+
+
+@app.route(f"/bkt/{PARAMS}", methods=["POST"])
+@cross_origin()
+def params_upload_handler():
+    """
+    Stores itemParams and conceptMap (same format as in /bkt) so that /bkt requests can send
+    paramsVersion instead. Returns {"paramsVersion": str}
+    """
+    from .param_registry import registry as param_registry
+
+    if is_req_not_json_type(request):
+        resp = Response("Request body must be JSON",
+                        status=415, mimetype=TEXT_TYPE)
+        return resp
+
+    req_body = request.get_json()
+    item_params = req_body.get("itemParams", None)
+    concept_map = req_body.get("conceptMap", None)
+    if (item_params is None) or (concept_map is None):
+        resp = Response("You are missing a field",
+                        status=400, mimetype=TEXT_TYPE)
+        return resp
+    try:
+        convert_item_params_to_dataframe(item_params)
+    except Exception as exc:
+        resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
+        return resp
+
+    try:
+        param_set = param_registry.register(item_params, concept_map)
+    except Exception as exc:
+        resp = Response(f"Error: invalid conceptMap ({exc})", status=400, mimetype=TEXT_TYPE)
+        return resp
+    body = {"paramsVersion": param_set.version}
+    return Response(json.dumps(body), status=201, mimetype=JSON_TYPE)
+
+
+@app.route(f"/bkt/{PARAMS}/<version>", methods=["GET"])
+@cross_origin()
+def params_status_handler(version):
+    """
+    Checks whether a parameter set was uploaded. Returns {"paramsVersion": str, "numItems": int}
+    """
+    from .param_registry import registry as param_registry
+
+    param_set = param_registry.get(version)
+    if param_set is None:
+        resp = Response(f"Unknown paramsVersion {version}",
+                        status=404, mimetype=TEXT_TYPE)
+        return resp
+    body = {"paramsVersion": param_set.version, "numItems": len(param_set.item_params)}
+    return Response(json.dumps(body), status=200, mimetype=JSON_TYPE)
+
+
+def convert_item_params_to_dataframe(item_params):
+    """
+    item_params is json array:
+        [
+            {
+                eid: string,
+                slip: float,
+                guess: float,
+                concept: string,
+            }
+        ]
+
+    returns pandas representation of this json array. Raises ValueError if it is empty or not a list
+    """
+    import pandas as pd
+
+    if not isinstance(item_params, list) or len(item_params) == 0:
+        raise ValueError("Invalid item params provided")
+    for item in item_params:
+        if len(item) != 4:
+            raise ValueError("Invalid item params provided")
+        if ("eid" not in item) or ("slip" not in item) or ("guess" not in item) or ("concept" not in item):
+            raise ValueError("Invalid item params provided")
+    return pd.DataFrame(item_params)
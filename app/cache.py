@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache that evicts the least recently used entry once max_entries is reached
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    Cache of JSON-serializable values stored as one file per key in directory.
+
+    Keys must be safe to use as filenames (e.g. hex digests). Once the files in directory take up
+    more than max_bytes, the least recently read/written files are removed.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{}.json".format(key))
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path) as cache_file:
+                value = json.load(cache_file)
+            os.utime(path) # mark as recently used for eviction
+            return value
+        except (OSError, ValueError):
+            return default
+
+    def put(self, key, value):
+        path = self._path(key)
+        # write then rename so other processes never read a partial file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(value, cache_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            total_bytes = 0
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+            if total_bytes <= self.max_bytes:
+                return
+            files.sort()
+            for _, size, path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_bytes -= size
+                if total_bytes <= self.max_bytes:
+                    return
+
+
+class ResultCache:
+    """
+    Bounded cache of function results that expire after ttl seconds, with single-flight
+    coalescing: concurrent calls for a key that isn't cached yet wait for the first call's result
+    instead of computing it again.
+
+    hits, misses and coalesced count lookups answered from the cache, computed, and answered by
+    waiting on another call.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict() # key -> (expiry time, value), least recently used first
+        self._in_flight = {} # key -> _Call
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, function, *args, cacheable=None):
+        """
+        Returns the cached value for key, or function(*args) (cached only if cacheable(value) is
+        truthy, when cacheable is given). Errors are passed on to every waiting caller and not cached.
+        """
+        now = time.monotonic()
+        leader = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            call = self._in_flight.get(key)
+            if call is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                call = _Call()
+                self._in_flight[key] = call
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            value = function(*args)
+            call.value = value
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if call.error is None and self.max_entries > 0 and (cacheable is None or cacheable(call.value)):
+                    self._entries[key] = (time.monotonic() + self.ttl, call.value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            call.done.set()
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "size": len(self._entries)
+            }
+
+
+class _Call:
+    """
+    A computation in progress that other callers can wait on
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
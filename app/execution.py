@@ -0,0 +1,479 @@
+import hashlib
+import os
+import secrets
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from .worker_pool import get_pool, WorkerError, PoolExhausted
+from .worker import (decode_output, detect_limit_exceeded, get_deadline,
+                     kill_group, stream_decoder, OutputReader,
+                     LIMIT_TIMEOUT, LIMIT_CPU, LIMIT_MEMORY, LIMIT_OUTPUT)
+from .helpers import first_mismatch, split_lines
+from .cache import LRUCache, DiskCache
+from . import metrics
+
+PYTHON = os.environ.get("PYTHON_EXECUTABLE", "python")
+TEMP_DIR = "/tmp"
+
+# Execution modes
+POOL_MODE = "pool" # warm worker pool, source sent over a pipe (falls back to STDIN_MODE)
+STDIN_MODE = "stdin" # new interpreter per run, source piped to `python -`
+TEMPFILE_MODE = "tempfile" # new interpreter per run, source written to a file in TEMP_DIR
+EXECUTION_MODE = os.environ.get("EXECUTION_MODE", POOL_MODE)
+
+# Limits for every run (0 turns a limit off). A run that hits one is killed along with anything it
+# started, and its result has limit_exceeded set to one of LIMIT_TIMEOUT, LIMIT_CPU, LIMIT_MEMORY
+# or LIMIT_OUTPUT.
+RUN_LIMITS = {
+    "timeout": float(os.environ.get("RUN_TIMEOUT", 10)), # wall-clock seconds
+    "cpu": int(os.environ.get("RUN_CPU_LIMIT", 5)), # CPU seconds
+    "memory": int(os.environ.get("RUN_MEMORY_LIMIT", 256 * 1024 * 1024)), # address space bytes
+    "output": int(os.environ.get("RUN_OUTPUT_LIMIT", 1024 * 1024)) # stdout + stderr bytes
+}
+
+# reference (instructor test code) output cache
+REFERENCE_CACHE_SIZE = int(os.environ.get("REFERENCE_CACHE_SIZE", 512))
+REFERENCE_CACHE_DIR = os.environ.get("REFERENCE_CACHE_DIR", "")
+REFERENCE_CACHE_MAX_BYTES = int(os.environ.get("REFERENCE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Started as `python -c RUN_BOOTSTRAP cpu memory script` by ProcessRunStream: applies the CPU and
+# memory limits (as worker.apply_limits does) to the new interpreter itself, then runs script ("-"
+# for stdin) the way `python script` would. Setting them here rather than in a preexec_fn keeps
+# starting a run safe from the server's threads.
+RUN_BOOTSTRAP = """
+import sys
+try:
+    import resource
+except ImportError:
+    resource = None
+cpu, memory, script = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+if resource is not None:
+    if cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+del resource
+
+import os
+if script == "-":
+    filename, source = "<stdin>", sys.stdin.buffer.read()
+    sys.path[0] = ""
+else:
+    filename = script
+    with open(script, "rb") as script_file:
+        source = script_file.read()
+    sys.path[0] = os.path.dirname(os.path.realpath(script))
+sys.argv = [script]
+main_module = type(sys)("__main__")
+main_module.__file__ = filename
+main_module.__builtins__ = __builtins__
+sys.modules["__main__"] = main_module
+
+exit_code = 0
+try:
+    exec(compile(source, filename, "exec"), main_module.__dict__)
+except SystemExit as exc:
+    exit_code = exc.code
+except BaseException:
+    import traceback # only imported when needed, it takes longer than starting the interpreter
+    etype, value, tb = sys.exc_info()
+    # drop this frame so the traceback starts at the submitted code
+    traceback.print_exception(etype, value, tb.tb_next)
+    exit_code = 1
+sys.exit(exit_code)
+"""
+
+reference_cache = LRUCache(REFERENCE_CACHE_SIZE)
+reference_disk_cache = DiskCache(REFERENCE_CACHE_DIR, REFERENCE_CACHE_MAX_BYTES) if REFERENCE_CACHE_DIR else None
+
+# threads used to overlap reference runs with user runs (see compare_with_reference)
+REFERENCE_THREADS = int(os.environ.get("REFERENCE_THREADS", 4))
+reference_executor = ThreadPoolExecutor(max_workers=REFERENCE_THREADS)
+
+_python_version = None
+
+
+class RunResult(subprocess.CompletedProcess):
+    """
+    subprocess.CompletedProcess plus the limit (if any) that stopped the run early, and whether it
+    was stopped early on purpose (see RunStream.stop)
+    """
+
+    def __init__(self, args, returncode, stdout, stderr, limit_exceeded=None, stopped=False):
+        super().__init__(args, returncode, stdout, stderr)
+        self.limit_exceeded = limit_exceeded
+        self.stopped = stopped
+
+
+class RunStream:
+    """
+    A run of python source code under RUN_LIMITS whose stdout is read as it is produced.
+
+    Iterate over chunks() for stdout text, call stop() to kill the run early, then result() for a
+    RunResult (whose stdout is "" since it has already been handed out). As a context manager it
+    makes sure the run is finished and cleaned up on the way out.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.output_done = False
+        self.stop_requested = False
+        self._result = None
+        self._started = time.perf_counter()
+
+    def chunks(self):
+        for chunk in self._read_chunks():
+            yield chunk
+        self.output_done = True
+
+    def _read_chunks(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        # once all output has been read there is nothing left to compare, and the run is left to
+        # end (or hit a limit) on its own so result() reports how it really ended
+        if self.output_done:
+            return
+        self.stop_requested = True
+        kill_group(self.pid)
+
+    def result(self):
+        if self._result is None:
+            # anything left is read and dropped; after stop() that is at most a pipe's worth
+            for _ in self.chunks():
+                pass
+            self._result = self._finish()
+            if self.stop_requested and self._result.returncode == -signal.SIGKILL:
+                self._result.stopped = True
+                self._result.limit_exceeded = None
+            record_run(self._result, time.perf_counter() - self._started)
+        return self._result
+
+    def _finish(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.result()
+            return
+        self.stop()
+        try:
+            self.result()
+        except Exception:
+            pass # the error already on its way out is the useful one
+
+
+class PoolRunStream(RunStream):
+    """
+    RunStream on a pooled worker (see the stream op in worker.py)
+    """
+
+    def __init__(self, pool, source):
+        with metrics.timed("spawn"):
+            self._messages = pool.stream(source, RUN_LIMITS)
+            pid = next(self._messages)["pid"]
+        metrics.subprocesses_total.inc(mode=POOL_MODE)
+        super().__init__(pid)
+        self._exit = None
+
+    def _read_chunks(self):
+        for message in self._messages:
+            if message["event"] == "stdout":
+                yield message["data"]
+            elif message["event"] == "exit":
+                self._exit = message
+
+    def _finish(self):
+        if self._exit is None:
+            raise WorkerError("Worker stopped before the run finished")
+        return RunResult(args=[PYTHON], returncode=self._exit["returncode"], stdout="",
+                         stderr=self._exit["stderr"], limit_exceeded=self._exit["limitExceeded"])
+
+
+class ProcessRunStream(RunStream):
+    """
+    RunStream on a newly started interpreter running script (a file name, or "-" to run source
+    from stdin) through RUN_BOOTSTRAP, in its own process group. cleanup (if any) is called once it
+    has finished.
+    """
+
+    def __init__(self, script, source=None, cleanup=None):
+        self.args = [PYTHON, script]
+        self.cleanup = cleanup
+        with metrics.timed("spawn"):
+            self.process = subprocess.Popen([PYTHON, "-c", RUN_BOOTSTRAP,
+                                             str(RUN_LIMITS["cpu"]), str(RUN_LIMITS["memory"]), script],
+                                            stdin=subprocess.PIPE if source is not None else subprocess.DEVNULL,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE,
+                                            start_new_session=True)
+        metrics.subprocesses_total.inc(mode="process")
+        super().__init__(self.process.pid)
+        if source is not None:
+            try:
+                self.process.stdin.write(source.encode("utf-8"))
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        self._reader = OutputReader(self.pid,
+                                    self.process.stdout.fileno(),
+                                    self.process.stderr.fileno(),
+                                    get_deadline(RUN_LIMITS),
+                                    RUN_LIMITS["output"])
+        self._stdout_chunks = self._reader.stdout_chunks()
+        self._decoder = stream_decoder()
+
+    def _read_chunks(self):
+        for chunk in self._stdout_chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                yield text
+        text = self._decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def _finish(self):
+        process = self.process
+        deadline = self._reader.deadline
+        limit_exceeded = self._reader.limit_exceeded
+        try:
+            # the output pipes can close before the process exits, so the deadline still applies here
+            try:
+                process.wait(timeout=max(deadline - time.monotonic(), 0) if deadline else None)
+            except subprocess.TimeoutExpired:
+                kill_group(self.pid)
+                process.wait()
+                limit_exceeded = limit_exceeded or LIMIT_TIMEOUT
+        finally:
+            if process.poll() is None:
+                kill_group(self.pid)
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+            if self.cleanup is not None:
+                self.cleanup()
+
+        stderr = decode_output(self._reader.stderr)
+        if limit_exceeded is None:
+            limit_exceeded = detect_limit_exceeded(process.returncode, stderr, RUN_LIMITS)
+        return RunResult(args=self.args, returncode=process.returncode, stdout="",
+                         stderr=stderr, limit_exceeded=limit_exceeded)
+
+
+def run_code(source):
+    """
+    Runs python source code under RUN_LIMITS and returns a RunResult with returncode, stdout and
+    stderr (as text).
+
+    How the code is run depends on EXECUTION_MODE. In POOL_MODE a warm worker from the pool is
+    used when one is available, falling back to a new interpreter if the pool is disabled, busy or
+    broken.
+    """
+    if EXECUTION_MODE == TEMPFILE_MODE:
+        return run_code_from_file(source)
+    if EXECUTION_MODE == POOL_MODE:
+        pool = get_pool(PYTHON)
+        if pool is not None:
+            try:
+                start = time.perf_counter()
+                result = pool.run(source, RUN_LIMITS)
+                metrics.subprocesses_total.inc(mode=POOL_MODE)
+                run_result = RunResult(args=[PYTHON], returncode=result["returncode"],
+                                       stdout=result["stdout"], stderr=result["stderr"],
+                                       limit_exceeded=result["limitExceeded"])
+                # checking out the worker and forking can't be told apart from the run here
+                record_run(run_result, time.perf_counter() - start)
+                return run_result
+            except (WorkerError, PoolExhausted):
+                metrics.pool_fallbacks_total.inc()
+    return run_code_from_stdin(source)
+
+
+def run_code_from_stdin(source):
+    """
+    Runs python source code in a newly started interpreter, passing the source through stdin so
+    no file is ever written
+    """
+    return run_process("-", source)
+
+
+def run_code_from_file(source):
+    """
+    Runs python source code in a newly started interpreter via a temp file
+    """
+    # Create random hash for the temp file for no overlap
+    filename = "{}/{}.py".format(TEMP_DIR, secrets.token_urlsafe(16))
+    with open(filename, "w") as file_code:
+        file_code.write(source)
+    try:
+        return run_process(filename)
+    finally:
+        os.remove(filename)
+
+
+def run_process(script, source=None):
+    """
+    Runs script (see ProcessRunStream) in a new interpreter under RUN_LIMITS, writes source (if
+    any) to its stdin and returns a RunResult
+    """
+    run = ProcessRunStream(script, source)
+    stdout = "".join(run.chunks())
+    result = run.result()
+    result.stdout = stdout
+    return result
+
+
+def stream_code(source):
+    """
+    Same as run_code, but returns a RunStream so stdout can be read as it is produced
+    """
+    if EXECUTION_MODE == POOL_MODE:
+        pool = get_pool(PYTHON)
+        if pool is not None:
+            try:
+                return PoolRunStream(pool, source)
+            except (WorkerError, PoolExhausted):
+                metrics.pool_fallbacks_total.inc()
+    if EXECUTION_MODE == TEMPFILE_MODE:
+        filename = "{}/{}.py".format(TEMP_DIR, secrets.token_urlsafe(16))
+        with open(filename, "w") as file_code:
+            file_code.write(source)
+        return ProcessRunStream(filename, cleanup=lambda: os.remove(filename))
+    return ProcessRunStream("-", source)
+
+
+def run_reference_code(source):
+    """
+    Same as run_code, but for instructor-provided code (testCode, questionCode) whose output is
+    the same for every submission. Results are cached by a hash of the source and the interpreter
+    version, in memory and (if REFERENCE_CACHE_DIR is set) on disk.
+    """
+    key = reference_cache_key(source)
+    cached = get_cached_reference(key)
+    if cached is not None:
+        metrics.reference_cache_total.inc(result="hit")
+        return cached
+
+    metrics.reference_cache_total.inc(result="miss")
+    return cache_reference_run(key, run_code(source))
+
+
+def run_reference_unpooled(source, key):
+    """
+    Runs reference code in a newly started interpreter, never a pooled worker, and caches the
+    result under key
+    """
+    if EXECUTION_MODE == TEMPFILE_MODE:
+        return cache_reference_run(key, run_code_from_file(source))
+    return cache_reference_run(key, run_code_from_stdin(source))
+
+
+def cache_reference_run(key, result):
+    """
+    Caches a reference run under key, unless it was stopped by a limit, and returns it
+    """
+    if result.limit_exceeded is not None:
+        # may just have been a slow moment, so don't remember it
+        return result
+    cached = {
+        "returncode": result.returncode,
+        "stdout": result.stdout,
+        "stderr": result.stderr
+    }
+    reference_cache.put(key, cached)
+    if reference_disk_cache is not None:
+        reference_disk_cache.put(key, cached)
+    return result
+
+
+def compare_with_reference(user_source, reference_source):
+    """
+    Runs user code and reference code at the same time and compares their stdout line by line as
+    the user's code produces it. The user's code is stopped at the first line that differs, so a
+    wrong answer that prints a lot finishes early and its output is never held in memory.
+
+    A cached reference result is used as is. Otherwise the reference runs on reference_executor in
+    a new interpreter rather than a pooled worker: the user's run may hold the last free worker
+    while it waits for the reference output, and the reference would then wait out
+    WORKER_ACQUIRE_TIMEOUT.
+
+    Returns (user_result, reference_result, mismatch). mismatch is None if the outputs are the
+    same, otherwise (expected line, got line) for the first line that differs ("" for a missing
+    line). If the reference code fails, nothing is compared and the user's code runs to the end.
+    user_result.stdout is always "" and user_result.stopped is True if it was stopped early.
+    """
+    key = reference_cache_key(reference_source)
+    reference_result = get_cached_reference(key)
+    reference_future = None
+    if reference_result is None:
+        metrics.reference_cache_total.inc(result="miss")
+        reference_future = reference_executor.submit(metrics.in_request(run_reference_unpooled),
+                                                     reference_source, key)
+    else:
+        metrics.reference_cache_total.inc(result="hit")
+
+    mismatch = None
+    try:
+        with stream_code(user_source) as user_run:
+            if reference_future is not None:
+                reference_result = reference_future.result()
+            if reference_result.returncode == 0:
+                mismatch = first_mismatch(reference_result.stdout.split("\n"),
+                                          split_lines(user_run.chunks()))
+                if mismatch is not None:
+                    user_run.stop()
+    except BaseException:
+        # never leave the reference run behind, even if the user run failed
+        if reference_future is not None:
+            wait([reference_future])
+        raise
+    return user_run.result(), reference_result, mismatch
+
+
+def record_run(result, seconds):
+    """
+    Adds a finished run to the metrics: its time from start (or, for a pooled run, checkout) to
+    exit as the "run" stage, and the limit that stopped it, if any
+    """
+    metrics.record("run", seconds)
+    if result.limit_exceeded is not None:
+        metrics.run_limit_exceeded_total.inc(limit=result.limit_exceeded)
+
+
+def get_cached_reference(key):
+    """
+    Returns the cached reference run for key as a RunResult, or None
+    """
+    cached = reference_cache.get(key)
+    if cached is None and reference_disk_cache is not None:
+        cached = reference_disk_cache.get(key)
+        if cached is not None:
+            reference_cache.put(key, cached)
+    if cached is None:
+        return None
+    return RunResult(args=[PYTHON], returncode=cached["returncode"],
+                     stdout=cached["stdout"], stderr=cached["stderr"])
+
+
+def reference_cache_key(source):
+    digest = hashlib.sha256()
+    digest.update(python_version().encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def python_version():
+    """
+    Version string of the interpreter that runs submitted code (looked up once per process)
+    """
+    global _python_version
+    if _python_version is None:
+        _python_version = subprocess.run([PYTHON, "-c", "import sys; print(sys.version)"],
+                                         capture_output=True,
+                                         universal_newlines=True).stdout.strip()
+    return _python_version
@@ -0,0 +1,233 @@
+"""
+Estimates BKT parameters from a response log: init and transfer for each concept (read or write)
+and slip and guess for each exercise, by expectation maximization (Baum-Welch) over every learner's
+response sequences.
+
+Each (concept, is_read) is fit on its own, so concepts are spread over a process pool. Within a
+concept, the forward-backward passes advance every learner's sequence one step per iteration with
+array operations, as replay.py does.
+
+The results are in the shapes the rest of the app uses: item params with columns eid, slip, guess,
+concept, is_read (pknown_seq, replay; bkt_item_params() gives the 4 keys /bkt expects) and concept
+params with columns concept, is_read, init, trasfer.
+
+Usage (from the repo root):
+    python -m app.fit LOG.csv ITEMS.csv OUT_DIR [--processes N] [--max-iter N] [--tol X]
+
+LOG.csv has the df_opp columns (uid, eid, step, correct). ITEMS.csv maps each eid to its concept
+and is_read, optionally with starting slip and guess values. OUT_DIR gets item_params.json (for
+/bkt), item_params.csv and concept_params.csv.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from .bkt import CONCEPT, IS_READ, INIT, TRANSFER, SLIP, GUESS, EID, UID, STEP, CORRECT
+from .replay import sequence_positions
+
+# starting values for parameters that aren't given
+DEFAULT_INIT = 0.3
+DEFAULT_TRANSFER = 0.1
+DEFAULT_SLIP = 0.1
+DEFAULT_GUESS = 0.2
+
+# fitted parameters are kept in [MIN_PARAM, 1 - MIN_PARAM], and slip and guess below MAX_SLIP_GUESS
+# so that a correct answer is always evidence the concept is known
+MIN_PARAM = 1e-4
+MAX_SLIP_GUESS = 0.5
+
+
+def fit(df_opp, items, processes=None, max_iter=100, tol=1e-6):
+    """
+    Fit BKT parameters to df_opp. Returns (item_params, concept_params) as pd.DataFrames.
+
+    Parameters
+    ----------
+    df_opp: pd.DataFrame
+        dataframe which records the correctness of responses for users. columns: uid, eid, step, correct
+    items: pd.DataFrame
+        eid, concept, is_read of each exercise, and optionally starting slip and guess. If an eid
+        appears more than once, its first row is used. Exercises nobody answered keep their
+        starting values.
+    processes: int
+        processes to fit concepts in (None for one per CPU, 1 to fit in this process)
+    max_iter: int
+        maximum EM iterations per concept
+    tol: float
+        EM stops once the mean log-likelihood per response improves by less than this
+    """
+    items = items.drop_duplicates(EID).reset_index(drop=True)
+    item_slip = items[SLIP].values.astype(float) if SLIP in items else np.full(len(items), DEFAULT_SLIP)
+    item_guess = items[GUESS].values.astype(float) if GUESS in items else np.full(len(items), DEFAULT_GUESS)
+    item_index = pd.Series(np.arange(len(items)), index=items[EID].values)
+
+    df = df_opp[df_opp[EID].isin(item_index.index)]
+    item_rows = item_index[df[EID].values].values
+    concept_keys = [items[CONCEPT].values[item_rows], items[IS_READ].values[item_rows].astype(bool)]
+
+    tasks = []
+    for key, response_rows in pd.Series(np.arange(len(df))).groupby(concept_keys, sort=True):
+        response_rows = response_rows.values
+        rows = item_rows[response_rows]
+        task_items, item_codes = np.unique(rows, return_inverse=True)
+        tasks.append((key, task_items, (
+            df[UID].values[response_rows], df[STEP].values[response_rows],
+            df[CORRECT].values[response_rows].astype(bool), item_codes,
+            item_slip[task_items], item_guess[task_items], max_iter, tol)))
+
+    if processes == 1 or len(tasks) <= 1:
+        fitted = [fit_concept(*args) for _, _, args in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            fitted = list(executor.map(fit_concept, *zip(*[args for _, _, args in tasks])))
+
+    concept_rows = []
+    for (key, task_items, _), (slip, guess, init, transfer) in zip(tasks, fitted):
+        item_slip[task_items] = slip
+        item_guess[task_items] = guess
+        concept_rows.append({CONCEPT: key[0], IS_READ: key[1], INIT: init, TRANSFER: transfer})
+
+    item_params = pd.DataFrame({EID: items[EID].values, SLIP: item_slip, GUESS: item_guess,
+                                CONCEPT: items[CONCEPT].values, IS_READ: items[IS_READ].values.astype(bool)})
+    concept_params = pd.DataFrame(concept_rows, columns=[CONCEPT, IS_READ, INIT, TRANSFER])
+    return item_params, concept_params
+
+
+def fit_concept(uids, steps, correct, item_codes, slip, guess, max_iter, tol,
+                init=DEFAULT_INIT, transfer=DEFAULT_TRANSFER):
+    """
+    EM for one concept's responses (one entry per response; item_codes index slip and guess).
+    Returns fitted (slip, guess, init, transfer).
+    """
+    _, sequence_ids = np.unique(uids, return_inverse=True)
+    sequences = Sequences(sequence_ids, sequence_positions(sequence_ids, steps, np.unique(uids)))
+    slip = np.clip(slip, MIN_PARAM, MAX_SLIP_GUESS)
+    guess = np.clip(guess, MIN_PARAM, MAX_SLIP_GUESS)
+    first = sequences.positions == 0
+    has_next = sequences.next_response >= 0
+
+    prev_log_likelihood = None
+    for _ in range(max_iter):
+        known, transferred, log_likelihood = forward_backward(
+            sequences, correct, slip[item_codes], guess[item_codes], init, transfer)
+        unknown = 1.0 - known
+
+        init = known[first].mean()
+        transfer = transferred.sum() / max(unknown[has_next].sum(), MIN_PARAM)
+        unknown_per_item = np.bincount(item_codes, unknown, len(slip))
+        known_per_item = np.bincount(item_codes, known, len(slip))
+        answered = (unknown_per_item + known_per_item) > 0
+        guess = np.where(answered, np.bincount(item_codes, unknown * correct, len(slip)) /
+                         np.maximum(unknown_per_item, MIN_PARAM), guess)
+        slip = np.where(answered, np.bincount(item_codes, known * ~correct, len(slip)) /
+                        np.maximum(known_per_item, MIN_PARAM), slip)
+
+        init = float(np.clip(init, MIN_PARAM, 1 - MIN_PARAM))
+        transfer = float(np.clip(transfer, MIN_PARAM, 1 - MIN_PARAM))
+        slip = np.clip(slip, MIN_PARAM, MAX_SLIP_GUESS)
+        guess = np.clip(guess, MIN_PARAM, MAX_SLIP_GUESS)
+
+        mean_log_likelihood = log_likelihood / len(correct)
+        if prev_log_likelihood is not None and abs(mean_log_likelihood - prev_log_likelihood) < tol:
+            break
+        prev_log_likelihood = mean_log_likelihood
+    return slip, guess, init, transfer
+
+
+class Sequences:
+    """
+    Response sequences laid out for stepping through all of them at once: order lists responses by
+    position (then sequence), with bounds[p]:bounds[p + 1] the slice at position p, and
+    next_response is the index of the next response in the same sequence (-1 for the last one)
+    """
+
+    def __init__(self, sequence_ids, positions):
+        self.sequence_ids = sequence_ids
+        self.positions = positions
+        self.num_sequences = sequence_ids.max() + 1 if len(sequence_ids) else 0
+        self.order = np.lexsort((sequence_ids, positions))
+        self.bounds = np.searchsorted(positions[self.order], np.arange(positions.max() + 2 if len(positions) else 1))
+
+        by_sequence = np.lexsort((positions, sequence_ids))
+        self.next_response = np.full(len(sequence_ids), -1)
+        same_sequence = sequence_ids[by_sequence[1:]] == sequence_ids[by_sequence[:-1]]
+        self.next_response[by_sequence[:-1][same_sequence]] = by_sequence[1:][same_sequence]
+
+    def slices(self, reverse=False):
+        slices = [self.order[lo:hi] for lo, hi in zip(self.bounds[:-1], self.bounds[1:])]
+        return reversed(slices) if reverse else slices
+
+
+def forward_backward(sequences, correct, slip, guess, init, transfer):
+    """
+    Scaled forward-backward pass over every sequence. Returns per response the probability the
+    concept was known when answering given the whole sequence, the expected number of
+    unknown -> known transitions right after it, and the total log-likelihood.
+    """
+    # probability of each response if the concept is known / unknown
+    emit_known = np.where(correct, 1.0 - slip, slip)
+    emit_unknown = np.where(correct, guess, 1.0 - guess)
+
+    filtered = np.empty(len(correct)) # P(known | responses so far), as posterior_pknown
+    scale = np.empty(len(correct))
+    pk = np.full(sequences.num_sequences, init)
+    for idx in sequences.slices():
+        sequence = sequences.sequence_ids[idx]
+        prior = pk[sequence]
+        known = prior * emit_known[idx]
+        scale[idx] = known + (1.0 - prior) * emit_unknown[idx]
+        filtered[idx] = known / scale[idx]
+        pk[sequence] = filtered[idx] + (1.0 - filtered[idx]) * transfer
+
+    backward_known = np.ones(len(correct))
+    backward_unknown = np.ones(len(correct))
+    for idx in sequences.slices(reverse=True):
+        nxt = sequences.next_response[idx]
+        idx, nxt = idx[nxt >= 0], nxt[nxt >= 0]
+        later_known = emit_known[nxt] * backward_known[nxt] / scale[nxt]
+        later_unknown = emit_unknown[nxt] * backward_unknown[nxt] / scale[nxt]
+        backward_known[idx] = later_known
+        backward_unknown[idx] = (1.0 - transfer) * later_unknown + transfer * later_known
+
+    known = filtered * backward_known
+    has_next = sequences.next_response >= 0
+    nxt = sequences.next_response[has_next]
+    transferred = (1.0 - filtered[has_next]) * transfer * emit_known[nxt] * backward_known[nxt] / scale[nxt]
+    return known, transferred, np.log(scale).sum()
+
+
+def bkt_item_params(item_params):
+    """
+    item_params as the list of {eid, slip, guess, concept} that /bkt and /bkt/params take
+    """
+    return [{EID: eid, SLIP: float(slip), GUESS: float(guess), CONCEPT: concept}
+            for eid, slip, guess, concept in zip(item_params[EID], item_params[SLIP],
+                                                 item_params[GUESS], item_params[CONCEPT])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit BKT parameters to a response log")
+    parser.add_argument("log", help="CSV with columns uid, eid, step, correct")
+    parser.add_argument("items", help="CSV with columns eid, concept, is_read (and optionally slip, guess)")
+    parser.add_argument("out_dir")
+    parser.add_argument("--processes", type=int, default=None, help="default: one per CPU")
+    parser.add_argument("--max-iter", type=int, default=100)
+    parser.add_argument("--tol", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    df_opp = pd.read_csv(args.log)
+    items = pd.read_csv(args.items)
+    item_params, concept_params = fit(df_opp, items, args.processes, args.max_iter, args.tol)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    with open(os.path.join(args.out_dir, "item_params.json"), "w") as item_params_file:
+        json.dump(bkt_item_params(item_params), item_params_file, indent=2)
+    item_params.to_csv(os.path.join(args.out_dir, "item_params.csv"), index=False)
+    concept_params.to_csv(os.path.join(args.out_dir, "concept_params.csv"), index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import itertools
+
+
 def parse_traceback(traceback):
     """
     helper function that parses the traceback from stdout of subprocess.run and return line that is important to user
@@ -33,4 +36,35 @@ def is_number(input):
     num = float(input)
   except ValueError:
     return False
-  return True
\ No newline at end of file
+  return True
+
+
+def split_lines(chunks):
+    """
+    Splits text that arrives in chunks into lines, the same way str.split("\n") would split the
+    whole text, without ever holding more than one line
+    """
+    partial = []
+    for chunk in chunks:
+        lines = chunk.split("\n")
+        if len(lines) == 1:
+            partial.append(chunk)
+            continue
+        partial.append(lines[0])
+        yield "".join(partial)
+        for line in lines[1:-1]:
+            yield line
+        partial = [lines[-1]]
+    yield "".join(partial)
+
+
+def first_mismatch(expected_lines, got_lines):
+    """
+    Compares two iterables of lines and returns (expected line, got line) for the first line that
+    differs, or None if they are the same. A missing line is reported as "".
+    Stops reading got_lines at the first difference.
+    """
+    for expected, got in itertools.zip_longest(expected_lines, got_lines):
+        if expected != got:
+            return ("" if expected is None else expected, "" if got is None else got)
+    return None
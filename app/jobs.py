@@ -0,0 +1,94 @@
+"""
+In-process scheduler for grading jobs that are submitted now and polled for later.
+
+Jobs and their results live in the memory of the web process that accepted them, so status
+requests must reach the same process (true for the default single gunicorn worker).
+
+Configuration (environment variables):
+    ASYNC_JOB_THREADS: jobs run at once per web process
+    ASYNC_JOB_MAX_PENDING: jobs that may be queued or running before new ones are rejected
+    ASYNC_JOB_TTL: seconds a finished job's result is kept
+"""
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_THREADS = int(os.environ.get("ASYNC_JOB_THREADS", 4))
+JOB_MAX_PENDING = int(os.environ.get("ASYNC_JOB_MAX_PENDING", 100))
+JOB_TTL = float(os.environ.get("ASYNC_JOB_TTL", 300))
+
+# Job statuses
+PENDING = "pending"
+DONE = "done"
+ERROR = "error"
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job is submitted while JOB_MAX_PENDING jobs are already queued or running
+    """
+    pass
+
+
+class JobScheduler:
+    """
+    Runs jobs on a fixed number of threads and keeps finished results for ttl seconds
+    """
+
+    def __init__(self, threads=JOB_THREADS, max_pending=JOB_MAX_PENDING, ttl=JOB_TTL):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._jobs = {}
+        self._finished = deque() # (finish time, job id), oldest first
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Queues function(*args) and returns the new job's id
+        """
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_pending:
+                raise JobQueueFull("{} jobs already pending".format(self._pending))
+            job_id = secrets.token_urlsafe(16)
+            self._jobs[job_id] = {"status": PENDING, "result": None}
+            self._pending += 1
+        self._executor.submit(self._run, job_id, function, args)
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns {status, result} for job_id, or None if there is no such job or it expired.
+        result is the function's return value when status is DONE and the error message when
+        status is ERROR.
+        """
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {"status": job["status"], "result": job["result"]}
+
+    def _run(self, job_id, function, args):
+        try:
+            status, result = DONE, function(*args)
+        except Exception as exc:
+            status, result = ERROR, str(exc)
+        with self._lock:
+            self._jobs[job_id].update(status=status, result=result)
+            self._finished.append((time.monotonic(), job_id))
+            self._pending -= 1
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._finished and now - self._finished[0][0] > self.ttl:
+            _, job_id = self._finished.popleft()
+            del self._jobs[job_id]
+
+
+scheduler = JobScheduler()
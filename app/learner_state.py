@@ -0,0 +1,228 @@
+"""
+Server-side store of each learner's probability of knowing each concept (read or write), so /bkt
+clients don't have to keep priorPknown and the server can report a learner's mastery.
+
+Estimates are kept in one float32 learner x (concept, is_read) matrix in a memory-mapped file, with
+empty cells set to NaN. The row of each learner and the column of each (concept, is_read) are the
+line they were added on in the append-only learners.txt / columns.txt, so 100k learners x 20
+columns take 8MB and reopening the store only reads those two files. Growing the matrix by learners
+extends the file in place; growing it by columns (rare) rewrites it as a new generation.
+
+Web processes share the files: every read and update holds an exclusive flock on the store's lock
+file, and first picks up learners, columns or a new generation added by other processes.
+
+Configuration (environment variables):
+    LEARNER_STATE_DIR: directory for the store ("" disables it)
+"""
+import contextlib
+import json
+import os
+import threading
+import numpy as np
+try:
+    import fcntl
+except ImportError: # not available on Windows, where the store is only safe in one process
+    fcntl = None
+
+LEARNER_STATE_DIR = os.environ.get("LEARNER_STATE_DIR", "")
+
+INITIAL_LEARNERS = 1024
+INITIAL_COLUMNS = 16
+
+
+class LearnerStateStore:
+    """
+    pknown by (uid, concept, is_read), stored in directory
+    """
+
+    def __init__(self, directory, initial_learners=INITIAL_LEARNERS, initial_columns=INITIAL_COLUMNS):
+        self.directory = directory
+        self.initial_learners = initial_learners
+        self.initial_columns = initial_columns
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._lock_pid = None
+        self._learners = {} # uid -> row
+        self._learners_offset = 0 # bytes of learners.txt already read
+        self._columns = {} # (concept, is_read) -> column
+        self._column_keys = []
+        self._columns_offset = 0
+        self._generation = None
+        self._matrix = None
+
+    def get(self, uid, concept, is_read):
+        """
+        Returns the stored pknown, or None if there is none
+        """
+        with self._locked():
+            return self._get(uid, (concept, bool(is_read)))
+
+    def update(self, uid, concept, is_read, function):
+        """
+        Atomically replaces the stored pknown with function(stored pknown or None) and returns the
+        new value. Nothing is stored if function raises.
+        """
+        key = (concept, bool(is_read))
+        with self._locked():
+            pk = function(self._get(uid, key))
+            # may grow (and replace) the matrix, so look these up before indexing it
+            row, col = self._row(uid), self._column(key)
+            self._matrix[row, col] = pk
+            return pk
+
+    def learner(self, uid):
+        """
+        Returns {(concept, is_read): pknown} for every concept the learner has an estimate for, or
+        None if the learner isn't in the store
+        """
+        with self._locked():
+            row = self._learners.get(uid)
+            if row is None:
+                return None
+            values = np.array(self._matrix[row, :len(self._column_keys)])
+            return {self._column_keys[col]: float(values[col]) for col in np.flatnonzero(~np.isnan(values))}
+
+    def __len__(self):
+        with self._locked():
+            return len(self._learners)
+
+    def _get(self, uid, key):
+        row = self._learners.get(uid)
+        col = self._columns.get(key)
+        if row is None or col is None:
+            return None
+        value = self._matrix[row, col]
+        return None if np.isnan(value) else float(value)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._lock_pid != os.getpid():
+                # flock is per open file, so a forked process needs its own
+                self._lock_file = open(self._path("lock"), "a")
+                self._lock_pid = os.getpid()
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """
+        Picks up changes made by other processes. Called with the lock held.
+        """
+        meta = self._read_meta()
+        if meta is None:
+            meta = {"generation": 0, "columns": self.initial_columns}
+            self._create_matrix(self._matrix_path(0), self.initial_learners, meta["columns"])
+            self._write_meta(meta)
+
+        self._learners_offset = self._read_lines("learners.txt", self._learners_offset, self._add_learner)
+        self._columns_offset = self._read_lines("columns.txt", self._columns_offset, self._add_column)
+
+        path = self._matrix_path(meta["generation"])
+        rows = os.path.getsize(path) // (4 * meta["columns"])
+        if self._generation != meta["generation"] or self._matrix.shape[0] != rows:
+            self._matrix = np.memmap(path, dtype=np.float32, mode="r+", shape=(rows, meta["columns"]))
+            self._generation = meta["generation"]
+
+    def _read_lines(self, name, offset, add):
+        try:
+            with open(self._path(name), "rb") as index_file:
+                index_file.seek(offset)
+                for line in index_file:
+                    add(json.loads(line.decode("utf-8")))
+                return index_file.tell()
+        except FileNotFoundError:
+            return offset
+
+    def _add_learner(self, uid):
+        self._learners[uid] = len(self._learners)
+
+    def _add_column(self, key):
+        key = (key[0], key[1])
+        self._columns[key] = len(self._column_keys)
+        self._column_keys.append(key)
+
+    def _append_line(self, name, value):
+        with open(self._path(name), "ab") as index_file:
+            index_file.write((json.dumps(value) + "\n").encode("utf-8"))
+        return os.path.getsize(self._path(name))
+
+    def _row(self, uid):
+        row = self._learners.get(uid)
+        if row is not None:
+            return row
+        self._learners_offset = self._append_line("learners.txt", uid)
+        self._add_learner(uid)
+        row = self._learners[uid]
+        if row >= self._matrix.shape[0]:
+            self._grow_rows(max(2 * self._matrix.shape[0], row + 1))
+        return row
+
+    def _column(self, key):
+        col = self._columns.get(key)
+        if col is not None:
+            return col
+        self._columns_offset = self._append_line("columns.txt", list(key))
+        self._add_column(key)
+        col = self._columns[key]
+        if col >= self._matrix.shape[1]:
+            self._grow_columns(max(2 * self._matrix.shape[1], col + 1))
+        return col
+
+    def _grow_rows(self, rows):
+        old_rows, columns = self._matrix.shape
+        self._matrix.flush()
+        path = self._matrix_path(self._generation)
+        with open(path, "r+b") as matrix_file:
+            matrix_file.truncate(4 * rows * columns)
+        self._matrix = np.memmap(path, dtype=np.float32, mode="r+", shape=(rows, columns))
+        self._matrix[old_rows:] = np.nan
+        self._matrix.flush()
+
+    def _grow_columns(self, columns):
+        rows, old_columns = self._matrix.shape
+        generation = self._generation + 1
+        path = self._matrix_path(generation)
+        matrix = self._create_matrix(path, rows, columns)
+        matrix[:, :old_columns] = self._matrix
+        matrix.flush()
+        old_path = self._matrix_path(self._generation)
+        self._write_meta({"generation": generation, "columns": columns})
+        self._matrix = matrix
+        self._generation = generation
+        os.remove(old_path)
+
+    def _matrix_path(self, generation):
+        return self._path("pknown.{}.f32".format(generation))
+
+    def _create_matrix(self, path, rows, columns):
+        matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(rows, columns))
+        matrix[:] = np.nan
+        matrix.flush()
+        return matrix
+
+    def _read_meta(self):
+        try:
+            with open(self._path("meta.json")) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        # write then rename so other processes never read a partial file
+        tmp_path = self._path("meta.json.{}.tmp".format(os.getpid()))
+        with open(tmp_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, self._path("meta.json"))
+
+
+learner_states = LearnerStateStore(LEARNER_STATE_DIR) if LEARNER_STATE_DIR else None
@@ -0,0 +1,257 @@
+"""
+Lightweight instrumentation: how long each stage of a request took (sent back in a Server-Timing
+header) and process-wide counters and histograms, served in the Prometheus text format at /metrics.
+
+Stages are timed with `with timed("stage"):`. Every timing is added to the stage histogram, and
+to the current request's timings if there is one. Work a request hands to another thread (grading
+threads, reference runs) counts towards the request if the function is wrapped with
+in_request(function) when it is submitted.
+
+Metrics are kept per process: with several gunicorn workers, each scrape of /metrics sees the
+worker that answered it.
+
+Configuration (environment variables):
+    SERVER_TIMING: "false" to leave the Server-Timing header out of responses (metrics are still kept)
+"""
+import bisect
+import contextlib
+import functools
+import os
+import threading
+import time
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "true") != "false"
+
+# seconds; requests range from under a millisecond (/checker/multipleChoice) to RUN_TIMEOUT
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape_label(value)) for name, value in pairs) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing count, per combination of label values
+    """
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {} if self.labels else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ["{}{} {}".format(self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in values]
+
+
+class Histogram:
+    """
+    Distribution of observed values (e.g. seconds) in cumulative buckets, per combination of label values
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # label values -> [count per bucket (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bucket] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(self.labels, key, [("le", format_value(bound))]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.labels, key), cumulative))
+        return lines
+
+
+class CallbackMetric:
+    """
+    Metric whose values are read when /metrics is scraped: function returns [(label values, value)].
+    For counts already kept elsewhere, e.g. ResultCache.stats()
+    """
+
+    def __init__(self, name, help, type, labels, function):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = tuple(labels)
+        self.function = function
+
+    def samples(self):
+        return ["{}{} {}".format(self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in self.function()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.histogram("koconut_request_seconds", "Time to answer a request", ("endpoint",))
+requests_total = registry.counter("koconut_requests_total", "Requests answered", ("endpoint", "status"))
+stage_seconds = registry.histogram("koconut_stage_seconds", "Time spent in each stage of a request", ("stage",))
+subprocesses_total = registry.counter(
+    "koconut_subprocesses_total", "Runs of submitted or reference code started, by how (pool or new process)", ("mode",))
+run_limit_exceeded_total = registry.counter(
+    "koconut_run_limit_exceeded_total", "Runs stopped by one of RUN_LIMITS (timeout, cpu, memory, output)", ("limit",))
+pool_fallbacks_total = registry.counter(
+    "koconut_pool_fallbacks_total", "Runs that fell back to a new interpreter because no pooled worker was usable")
+reference_cache_total = registry.counter(
+    "koconut_reference_cache_total", "Reference code lookups answered from the cache (hit) or run (miss)", ("result",))
+
+
+_local = threading.local()
+
+
+class RequestTimings:
+    """
+    Stage timings of one request
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = [] # (stage, seconds), appended from any thread working for the request
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self, total):
+        """
+        Server-Timing header value: each stage's total duration in ms (stages run more than once,
+        e.g. one per table cell, are added up), then the whole request's
+        """
+        durations = {}
+        for stage, seconds in list(self.stages):
+            durations[stage] = durations.get(stage, 0.0) + seconds
+        entries = ["{};dur={:.3f}".format(stage, seconds * 1000) for stage, seconds in durations.items()]
+        entries.append("total;dur={:.3f}".format(total * 1000))
+        return ", ".join(entries)
+
+
+def start_request():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def finish_request():
+    """
+    Returns the current request's timings (None if start_request wasn't called) and forgets them
+    """
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    return timings
+
+
+def current():
+    return getattr(_local, "timings", None)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record(stage, seconds):
+    """
+    Adds a stage timing measured some other way than with timed
+    """
+    stage_seconds.observe(seconds, stage=stage)
+    timings = current()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def in_request(function):
+    """
+    function, wrapped so that stages it times in another thread count towards the current request
+    """
+    timings = current()
+    if timings is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.timings = timings
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.timings = previous
+    return wrapper
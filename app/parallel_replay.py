@@ -0,0 +1,185 @@
+"""
+replay spread over several processes. Learners are split into contiguous blocks of roughly equal
+numbers of responses and each block is replayed by a worker process; every learner's sequences are
+in exactly one block, so the result is the same as replaying in one process.
+
+The parent maps every response to its item row and (concept, is_read) once and saves those arrays,
+the item parameters and the concept parameters as .npy files. Workers memory-map them read-only,
+so nothing but a block's bounds is pickled to a worker, and write their results into a shared
+memory-mapped output at their block's offset, so merging is just reading it back in input order.
+
+Usage (from the repo root):
+    python -m app.parallel_replay LOG.csv CONCEPT_PARAMS.csv ITEM_PARAMS OUT.csv [--processes N] [--check]
+
+--check also replays in this process and exits with status 1 unless the results are identical.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from .bkt import as_item_param_store, pcorrect, CONCEPT, IS_READ, EID, UID, STEP, CORRECT
+from .replay import (replay, concept_param_lookup, load_item_params, sequence_positions, replay_sequences,
+                     PK_PRIOR, PK, PCORRECT)
+
+# arrays shared with workers (saved as <name>.npy)
+RESPONSE_ARRAYS = ("uid_codes", "item_rows", "concept_keys", "steps", "correct")
+PARAM_ARRAYS = ("slip", "guess", "init", "transfer")
+RESULT_ARRAYS = (PK_PRIOR, PK, PCORRECT)
+
+
+def parallel_replay(df_opp, concept_params, item_params, processes=None, blocks_per_process=4):
+    """
+    Same as replay(df_opp, concept_params, item_params), computed by processes worker processes
+    (None for one per CPU). Learners are split into processes * blocks_per_process blocks so that
+    a slow block doesn't leave the other processes idle.
+    """
+    item_params = as_item_param_store(item_params)
+    if item_params.is_read is None:
+        raise ValueError("item_params must have an {} column to replay".format(IS_READ))
+    processes = processes or os.cpu_count() or 1
+
+    rows = item_params.rows(df_opp[EID].tolist())
+    df = df_opp[rows >= 0].copy()
+    rows = rows[rows >= 0]
+
+    # (concept, is_read) of each item row the log uses, as a code into init/transfer. As in replay,
+    # only those need concept params
+    lookup = concept_param_lookup(concept_params)
+    used_rows = np.unique(rows)
+    used_keys = list(zip(item_params.concept_codes[used_rows].tolist(),
+                         item_params.is_read[used_rows].tolist()))
+    keys = sorted(set(used_keys))
+    key_codes = {key: code for code, key in enumerate(keys)}
+    init = np.empty(len(keys))
+    transfer = np.empty(len(keys))
+    for (concept_code, is_read), code in key_codes.items():
+        concept = item_params.concepts[concept_code]
+        if (concept, is_read) not in lookup:
+            raise ValueError("No concept params for concept {} (is_read={})".format(concept, is_read))
+        init[code], transfer[code] = lookup[(concept, is_read)]
+    item_keys = np.full(len(item_params.eids), -1, dtype=int)
+    item_keys[used_rows] = [key_codes[key] for key in used_keys]
+
+    uid_names, uid_codes = np.unique(df[UID].values.astype(str), return_inverse=True)
+    # responses sorted by learner, so each block is a contiguous slice
+    order = np.argsort(uid_codes, kind='stable')
+    arrays = {
+        "uid_codes": uid_codes[order],
+        "item_rows": rows[order],
+        "concept_keys": item_keys[rows[order]],
+        "steps": df[STEP].values[order].astype(int),
+        "correct": df[CORRECT].values[order].astype(bool),
+        "slip": item_params.slip,
+        "guess": item_params.guess,
+        "init": init,
+        "transfer": transfer,
+    }
+
+    directory = tempfile.mkdtemp(prefix="replay-")
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+        for name in RESULT_ARRAYS:
+            np.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode="w+",
+                                      dtype=float, shape=(len(df),)).flush()
+
+        blocks = learner_blocks(arrays["uid_codes"], processes * blocks_per_process)
+        tasks = [(directory, lo, hi, uid_names[arrays["uid_codes"][lo]:arrays["uid_codes"][hi - 1] + 1],
+                  arrays["uid_codes"][lo]) for lo, hi in blocks]
+        if processes == 1:
+            for task in tasks:
+                replay_block(*task)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                # list() so a worker's exception is raised here
+                list(executor.map(replay_block, *zip(*tasks)))
+
+        # results are in learner order; put them back in input order
+        for name in RESULT_ARRAYS:
+            result = np.empty(len(df))
+            result[order] = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+            df[name] = result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    df[CONCEPT] = np.array(item_params.concepts, dtype=object)[item_params.concept_codes[rows]]
+    df[IS_READ] = item_params.is_read[rows]
+    # same column order as replay
+    return df[list(df_opp.columns) + [CONCEPT, IS_READ, PK_PRIOR, PK, PCORRECT]]
+
+
+def learner_blocks(uid_codes, num_blocks):
+    """
+    Splits sorted uid_codes into up to num_blocks (lo, hi) slices of roughly equal length that
+    never split a learner
+    """
+    if len(uid_codes) == 0:
+        return []
+    cuts = np.linspace(0, len(uid_codes), num_blocks + 1)[1:-1].astype(int)
+    # move each cut forward to the start of the next learner
+    cuts = np.searchsorted(uid_codes, uid_codes[cuts], side="left")
+    bounds = np.unique(np.r_[0, cuts, len(uid_codes)])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def replay_block(directory, lo, hi, uid_names, first_uid_code):
+    """
+    Replays responses lo:hi of the arrays saved in directory, writing results to the same slice of
+    the result arrays. Runs in a worker process.
+    """
+    def load(name, mode="r"):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode=mode)
+
+    uid_codes, item_rows, concept_keys, steps, correct = [load(name)[lo:hi] for name in RESPONSE_ARRAYS]
+    slip, guess, init, transfer = [load(name) for name in PARAM_ARRAYS]
+    item_rows = np.asarray(item_rows)
+
+    # one sequence per (uid, concept, is_read)
+    sequence_keys = (np.asarray(uid_codes) - first_uid_code) * len(init) + concept_keys
+    unique_keys, sequence_ids = np.unique(sequence_keys, return_inverse=True)
+    sequence_concepts = unique_keys % len(init)
+    positions = sequence_positions(sequence_ids, steps, uid_names[unique_keys // len(init)])
+
+    block_slip = slip[item_rows]
+    block_guess = guess[item_rows]
+    pk_prior, pk, _ = replay_sequences(sequence_ids, positions, np.asarray(correct), block_slip, block_guess,
+                                       init[sequence_concepts], transfer[sequence_concepts])
+    for name, result in zip(RESULT_ARRAYS, (pk_prior, pk, pcorrect(pk_prior, block_slip, block_guess))):
+        out = load(name, mode="r+")
+        out[lo:hi] = result
+        out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-estimate BKT knowledge over a response log on several processes")
+    parser.add_argument("log", help="CSV with columns uid, eid, step, correct")
+    parser.add_argument("concept_params", help="CSV with columns concept, is_read, init, trasfer")
+    parser.add_argument("item_params", help="CSV or JSON with columns eid, slip, guess, concept, is_read")
+    parser.add_argument("out", help="CSV to write replayed responses to")
+    parser.add_argument("--processes", type=int, default=None, help="default: one per CPU")
+    parser.add_argument("--check", action="store_true",
+                        help="also replay in one process and fail unless the results are identical")
+    args = parser.parse_args()
+
+    df_opp = pd.read_csv(args.log, dtype={UID: str, EID: str})
+    concept_params = pd.read_csv(args.concept_params)
+    item_params = as_item_param_store(load_item_params(args.item_params))
+    replayed = parallel_replay(df_opp, concept_params, item_params, args.processes)
+    replayed.to_csv(args.out, index=False)
+
+    if args.check:
+        expected = replay(df_opp, concept_params, item_params)
+        same = expected.index.equals(replayed.index) and list(expected.columns) == list(replayed.columns) and \
+            all(np.array_equal(expected[column].values, replayed[column].values) for column in expected.columns)
+        print("check: {}".format("identical to single-process replay" if same else "DIFFERS from single-process replay"))
+        if not same:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
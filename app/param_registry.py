@@ -0,0 +1,106 @@
+"""
+Registry of BKT parameter sets (item params + concept map) that are uploaded once and then referred
+to by version id in /bkt requests, instead of being sent and parsed on every request.
+
+A version id is the sha256 of the parameter set's canonical JSON, so uploading the same parameters
+twice returns the same id. Parsed sets are kept in memory; if PARAM_REGISTRY_DIR is set they are also
+written there, so that other web processes (e.g. other gunicorn workers) can load a version they
+did not receive the upload for.
+
+Configuration (environment variables):
+    PARAM_REGISTRY_DIR: directory uploaded parameter sets are persisted to ("" keeps them in memory only)
+    PARAM_REGISTRY_SIZE: parsed parameter sets kept in memory per web process
+"""
+import hashlib
+import json
+import os
+from .bkt import ItemParamStore, ConceptGraph
+from .cache import LRUCache
+
+PARAM_REGISTRY_DIR = os.environ.get("PARAM_REGISTRY_DIR", "")
+PARAM_REGISTRY_SIZE = int(os.environ.get("PARAM_REGISTRY_SIZE", 32))
+
+
+class ParamSet:
+    """
+    A parsed parameter set: the item params as sent (list of dicts) and indexed as an
+    ItemParamStore, plus the concept map as sent and compiled as a ConceptGraph
+    """
+
+    def __init__(self, version, item_params, concept_map):
+        self.version = version
+        self.item_params = item_params
+        self.concept_map = concept_map
+        self.item_param_store = ItemParamStore.from_records(item_params)
+        self.concept_graph = ConceptGraph(concept_map)
+
+
+def param_set_version(item_params, concept_map):
+    payload = json.dumps({"itemParams": item_params, "conceptMap": concept_map},
+                         sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ParamRegistry:
+    """
+    Parameter sets by version id, in memory (up to max_entries) and, if directory is given, on disk
+    """
+
+    def __init__(self, directory=PARAM_REGISTRY_DIR, max_entries=PARAM_REGISTRY_SIZE):
+        self.directory = directory
+        self._param_sets = LRUCache(max_entries)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def register(self, item_params, concept_map):
+        """
+        Stores a parameter set whose item params are already validated and returns its ParamSet.
+        Raises an exception if concept_map is malformed.
+        """
+        version = param_set_version(item_params, concept_map)
+        param_set = self._param_sets.get(version)
+        if param_set is None:
+            param_set = ParamSet(version, item_params, concept_map)
+            self._param_sets.put(version, param_set)
+            self._write(param_set)
+        return param_set
+
+    def get(self, version):
+        """
+        Returns the ParamSet for version, or None if it was never uploaded
+        """
+        param_set = self._param_sets.get(version)
+        if param_set is None:
+            param_set = self._read(version)
+            if param_set is not None:
+                self._param_sets.put(version, param_set)
+        return param_set
+
+    def _path(self, version):
+        return os.path.join(self.directory, "{}.json".format(version))
+
+    def _write(self, param_set):
+        if not self.directory:
+            return
+        path = self._path(param_set.version)
+        if os.path.exists(path):
+            return
+        # write then rename so other processes never read a partial file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as param_file:
+            json.dump({"itemParams": param_set.item_params, "conceptMap": param_set.concept_map}, param_file)
+        os.replace(tmp_path, path)
+
+    def _read(self, version):
+        # version comes from the request, so only ever look up things shaped like our ids
+        if not self.directory or len(version) != 64 or any(c not in "0123456789abcdef" for c in version):
+            return None
+        try:
+            with open(self._path(version)) as param_file:
+                data = json.load(param_file)
+        except (OSError, ValueError):
+            return None
+        return ParamSet(version, data["itemParams"], data["conceptMap"])
+
+
+registry = ParamRegistry()
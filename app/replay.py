@@ -0,0 +1,233 @@
+"""
+Batch re-estimation of BKT knowledge over a whole response log (e.g. after item or concept
+parameters are refit). Does what pknown_seq and pcorrect_seq do for one learner and concept, for
+every (learner, concept, is_read) sequence in the log at once.
+
+The log is grouped into sequences once, eids are mapped to slip/guess arrays once, and the BKT
+recurrence then advances every sequence by one step per iteration with array operations, so the
+number of python-level iterations is the length of the longest sequence rather than the number of
+responses.
+
+Logs too big for memory can be replayed in chunks with StreamingReplay, or from the command line
+(from the repo root):
+    python -m app.replay LOG CONCEPT_PARAMS.csv ITEM_PARAMS OUT [--chunksize N] [--not-uid-ordered]
+
+LOG is a CSV or .jsonl file with the df_opp columns (uid, eid, step, correct), sorted by uid then
+step unless --not-uid-ordered is given. ITEM_PARAMS is a CSV or JSON file with an is_read column
+(e.g. from app.fit). OUT gets every replayed response, as CSV or (if it ends in .jsonl) JSON lines;
+use - for stdout.
+"""
+import argparse
+import json
+import sys
+import numpy as np
+import pandas as pd
+from .bkt import (as_item_param_store, pcorrect, posterior_pknown_arrays,
+                  CONCEPT, IS_READ, INIT, TRANSFER, EID, UID, STEP, CORRECT)
+
+# columns added by replay
+PK_PRIOR = 'pk_prior'
+PK = 'pk'
+PCORRECT = 'pcorrect'
+
+
+def replay(df_opp, concept_params, item_params):
+    """
+    Re-estimate knowledge after every response in df_opp.
+
+    Each learner's responses to the exercises of one concept (read or write) form a sequence whose
+    steps must be numbered 1..n, as in pknown_seq. Responses to exercises that aren't in item_params
+    are dropped. If an eid appears more than once in item_params, its first row is used.
+
+    Returns pd.DataFrame with df_opp's columns and index (same row order), plus concept, is_read,
+    pk_prior (probability known before the response), pk (after it, as pknown_seq) and pcorrect
+    (predicted probability the response is correct, as pcorrect_seq)
+
+    Parameters
+    ----------
+    df_opp: pd.DataFrame
+        dataframe which records the correctness of responses for users. columns: uid, eid, step, correct
+    concept_params: pd.DataFrame
+        concept parameters (concept, is_read, init, transfer)
+    item_params: ItemParamStore (or pd.DataFrame, list of dicts)
+        item parameters (eid, slip, guess, concept, is_read)
+    """
+    return StreamingReplay(concept_params, item_params, uid_ordered=False).replay_chunk(df_opp)
+
+
+class StreamingReplay:
+    """
+    replay for a log that arrives in chunks (see read_log_chunks), keeping each sequence's latest
+    pk and step between chunks. A sequence may continue in a later chunk.
+
+    If uid_ordered, the log must be sorted by uid (then step), so once a chunk ends every learner
+    but its last is finished and their state is dropped: memory then depends on the number of
+    concepts learners work on and the chunk size, not on the size of the log.
+    """
+
+    def __init__(self, concept_params, item_params, uid_ordered=True):
+        self.item_params = as_item_param_store(item_params)
+        if self.item_params.is_read is None:
+            raise ValueError("item_params must have an {} column to replay".format(IS_READ))
+        self.concept_params = concept_param_lookup(concept_params)
+        self.uid_ordered = uid_ordered
+        self.state = {} # (uid, concept, is_read) -> (pk, last step)
+
+    def replay_chunk(self, df_opp):
+        """
+        Same as replay, for the next chunk of the log
+        """
+        item_params = self.item_params
+        rows = item_params.rows(df_opp[EID].tolist())
+        df = df_opp[rows >= 0].copy()
+        rows = rows[rows >= 0]
+        df[CONCEPT] = np.array(item_params.concepts, dtype=object)[item_params.concept_codes[rows]]
+        df[IS_READ] = item_params.is_read[rows]
+        slip = item_params.slip[rows]
+        guess = item_params.guess[rows]
+        correct = df[CORRECT].values.astype(bool)
+
+        # one sequence per (uid, concept, is_read)
+        sequence_ids = df.groupby([UID, CONCEPT, IS_READ], sort=False).ngroup().values
+        sequences = df[[UID, CONCEPT, IS_READ]].groupby(sequence_ids).first()
+        keys = list(zip(sequences[UID], sequences[CONCEPT], sequences[IS_READ].astype(bool)))
+        init = np.empty(len(keys))
+        transfer = np.empty(len(keys))
+        first_steps = np.ones(len(keys), dtype=int)
+        for idx, key in enumerate(keys):
+            if key[1:] not in self.concept_params:
+                raise ValueError("No concept params for concept {} (is_read={})".format(key[1], key[2]))
+            init[idx], transfer[idx] = self.concept_params[key[1:]]
+            if key in self.state:
+                # continues a sequence from an earlier chunk
+                init[idx], last_step = self.state[key]
+                first_steps[idx] = last_step + 1
+        positions = sequence_positions(sequence_ids, df[STEP].values, sequences[UID].values, first_steps)
+
+        pk_prior, pk, pk_final = replay_sequences(sequence_ids, positions, correct, slip, guess, init, transfer)
+        df[PK_PRIOR] = pk_prior
+        df[PK] = pk
+        df[PCORRECT] = pcorrect(pk_prior, slip, guess)
+
+        last_steps = first_steps + np.bincount(sequence_ids, minlength=len(keys)) - 1
+        for idx, key in enumerate(keys):
+            self.state[key] = (pk_final[idx], last_steps[idx])
+        if self.uid_ordered and len(df_opp) > 0:
+            last_uid = df_opp[UID].iloc[-1]
+            self.state = {key: value for key, value in self.state.items() if key[0] == last_uid}
+        return df
+
+    def replay_chunks(self, chunks):
+        """
+        Generator of replay_chunk(chunk) for each chunk
+        """
+        for chunk in chunks:
+            yield self.replay_chunk(chunk)
+
+
+def read_log_chunks(path, chunksize):
+    """
+    Reads a response log (columns uid, eid, step, correct) from a CSV or, if path ends in .jsonl,
+    JSON lines file, as DataFrames of up to chunksize rows
+    """
+    if path.endswith(".jsonl"):
+        return pd.read_json(path, lines=True, chunksize=chunksize, dtype={UID: str, EID: str})
+    return pd.read_csv(path, chunksize=chunksize, dtype={UID: str, EID: str})
+
+
+def concept_param_lookup(concept_params):
+    """
+    {(concept, is_read): (init, transfer)} from the concept_params DataFrame
+    """
+    by_concept = {}
+    for concept, is_read, init, transfer in zip(concept_params[CONCEPT], concept_params[IS_READ],
+                                                concept_params[INIT], concept_params[TRANSFER]):
+        by_concept.setdefault((concept, bool(is_read)), (float(init), float(transfer)))
+    return by_concept
+
+
+def sequence_positions(sequence_ids, steps, uids, first_steps=None):
+    """
+    0-based position of each response in its sequence, checking that each sequence's steps are
+    first_step, first_step + 1, ... with exactly one response each (first_step is 1 unless given
+    per sequence in first_steps)
+    """
+    steps = np.asarray(steps)
+    order = np.lexsort((steps, sequence_ids))
+    sorted_ids = sequence_ids[order]
+    # index in order at which each response's sequence starts
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    sequence_start = np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    positions = np.empty(len(order), dtype=int)
+    positions[order] = np.arange(len(order)) - sequence_start
+
+    expected = positions + (1 if first_steps is None else first_steps[sequence_ids])
+    bad = np.flatnonzero(steps != expected)
+    if len(bad) > 0:
+        first_bad = bad[np.argmin(positions[bad])]
+        raise Exception('Did not find exactly 1 response for user {} for step {}'
+                        .format(uids[sequence_ids[first_bad]], expected[first_bad]))
+    return positions
+
+
+def replay_sequences(sequence_ids, positions, correct, slip, guess, init, transfer):
+    """
+    Runs the BKT recurrence over many sequences at once.
+
+    sequence_ids, positions (0-based, see sequence_positions), correct, slip and guess have one
+    entry per response; init (probability known before the first response) and transfer have one
+    entry per sequence. Returns (pk_prior, pk) per response and the final pk per sequence.
+    """
+    pk_state = np.array(init, dtype=float)
+    pk_prior = np.empty(len(sequence_ids))
+    pk = np.empty(len(sequence_ids))
+
+    # responses grouped by position, so each step of every sequence is one slice
+    order = np.lexsort((sequence_ids, positions))
+    bounds = np.searchsorted(positions[order], np.arange(positions.max() + 2 if len(positions) else 1))
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        idx = order[lo:hi]
+        sequences = sequence_ids[idx]
+        prior = pk_state[sequences]
+        posterior = posterior_pknown_arrays(correct[idx], slip[idx], guess[idx], transfer[sequences], prior)
+        pk_prior[idx] = prior
+        pk[idx] = posterior
+        pk_state[sequences] = posterior
+    return pk_prior, pk, pk_state
+
+
+def load_item_params(path):
+    if path.endswith(".json"):
+        with open(path) as item_params_file:
+            return pd.DataFrame(json.load(item_params_file))
+    return pd.read_csv(path, dtype={EID: str})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-estimate BKT knowledge over a response log, in chunks")
+    parser.add_argument("log", help="CSV or .jsonl with columns uid, eid, step, correct")
+    parser.add_argument("concept_params", help="CSV with columns concept, is_read, init, trasfer")
+    parser.add_argument("item_params", help="CSV or JSON with columns eid, slip, guess, concept, is_read")
+    parser.add_argument("out", help="CSV or .jsonl file to write replayed responses to (- for stdout)")
+    parser.add_argument("--chunksize", type=int, default=100000, help="responses read at a time")
+    parser.add_argument("--not-uid-ordered", action="store_true",
+                        help="log isn't sorted by uid, so keep every learner's state until the end")
+    args = parser.parse_args()
+
+    streaming = StreamingReplay(pd.read_csv(args.concept_params), load_item_params(args.item_params),
+                                uid_ordered=not args.not_uid_ordered)
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    try:
+        for idx, replayed in enumerate(streaming.replay_chunks(read_log_chunks(args.log, args.chunksize))):
+            if args.out.endswith(".jsonl"):
+                if len(replayed) > 0:
+                    out.write(replayed.to_json(orient="records", lines=True).rstrip("\n") + "\n")
+            else:
+                replayed.to_csv(out, header=(idx == 0), index=False)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
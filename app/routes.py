@@ -2,13 +2,17 @@ from app import app
 from flask import request, Response
 import re
 import json
-import secrets
-import subprocess
 import os
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from flask_cors import cross_origin
-from .bkt import posterior_pknown, order_next_questions, filter_ordered_questions_by_concepts
-import pandas as pd
 from .helpers import parse_traceback, parse_response
+from .cache import ResultCache
+from . import metrics
+from .jobs import scheduler, JobQueueFull, PENDING, ERROR
+from .execution import (run_reference_code, compare_with_reference, RUN_LIMITS,
+                        LIMIT_TIMEOUT, LIMIT_CPU, LIMIT_MEMORY, LIMIT_OUTPUT)
 
 JSON_TYPE = "application/json"
 TEXT_TYPE = "text/plain"
@@ -24,7 +28,66 @@ CHECKBOX_QUESTION = "checkboxQuestion"
 MEMORY_TABLE = "memoryTable"
 EID = "eid"
 
-TEMP_DIR = "/tmp"
+BATCH = "batch"
+JOBS = "jobs"
+CACHE_STATS = "cacheStats"
+METRICS = "metrics"
+
+# Threads shared by all requests for grading questions that run code (table cells, batch jobs),
+# and how many of those one request may have in flight at once
+GRADING_THREADS = int(os.environ.get("GRADING_THREADS", 8))
+GRADING_CONCURRENCY = int(os.environ.get("GRADING_CONCURRENCY", 2))
+grading_executor = ThreadPoolExecutor(max_workers=GRADING_THREADS)
+
+# Response bodies of recently graded writeCode and shortAnswer submissions, so identical
+# submissions (and client retries) are only graded once
+GRADING_CACHE_SIZE = int(os.environ.get("GRADING_CACHE_SIZE", 4096))
+GRADING_CACHE_TTL = float(os.environ.get("GRADING_CACHE_TTL", 600))
+grading_cache = ResultCache(GRADING_CACHE_SIZE, GRADING_CACHE_TTL)
+metrics.registry.register(metrics.CallbackMetric(
+    "koconut_grading_cache_total", "Grading cache lookups (see cached_grading)", "counter", ("result",),
+    lambda: [((result,), grading_cache.stats()[stat]) for result, stat in
+             (("hit", "hits"), ("miss", "misses"), ("coalesced", "coalesced"))]))
+
+def cached_grading(question_type):
+    """
+    Decorator for *_check_correctness functions that caches their response bodies in
+    grading_cache, keyed by a hash of question_type and the arguments. Concurrent identical
+    calls wait on one grading run. Bodies for code stopped by a limit aren't cached since that
+    can depend on how busy the server was.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            key = hashlib.sha256(json.dumps([question_type, args]).encode("utf-8")).hexdigest()
+            return grading_cache.get_or_compute(key, function, *args,
+                                                cacheable=lambda body: "limitExceeded" not in body)
+        return wrapper
+    return decorator
+
+
+@app.before_request
+def start_request_timing():
+    metrics.start_request()
+
+
+@app.after_request
+def finish_request_timing(resp):
+    """
+    Records the request in the metrics and, unless SERVER_TIMING is off, sends back how long each
+    stage took in a Server-Timing header
+    """
+    timings = metrics.finish_request()
+    if timings is None:
+        return resp
+    total = timings.elapsed()
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.request_seconds.observe(total, endpoint=endpoint)
+    metrics.requests_total.inc(endpoint=endpoint, status=resp.status_code)
+    if metrics.SERVER_TIMING:
+        resp.headers["Server-Timing"] = timings.header(total)
+    return resp
+
 
 # @app.route("/") # For dev/debugging only.
 # def hello():
@@ -46,69 +109,89 @@ def writecode_handler():
         return resp
 
     # Get request body
-    req_body = request.get_json()
+    with metrics.timed("parse"):
+        req_body = request.get_json()
     user_answer = req_body.get("userAnswer", "")
     test_code = req_body.get("testCode", "")
 
-    # TODO: REFACTOR USING METHOD DEFINED BELOW
-
-    # Create random hashes for each temp file for no overlap
-    filename_user_answer = secrets.token_urlsafe(16)
-    filename_test_code = secrets.token_urlsafe(16)
-
-    # Put code into those temp files
-    file_user_answer = open("{}/{}.py".format(TEMP_DIR, filename_user_answer), "w")
-    file_test_code = open("{}/{}.py".format(TEMP_DIR, filename_test_code), "w")
-    file_user_answer.write(user_answer)
-    file_test_code.write(test_code)
-
-    # Close the files
-    file_user_answer.close()
-    file_test_code.close()
-
-    # Check the std output of all files
-    user_output = ""
-    test_output = ""
-    user_output = subprocess.run(["python", "{}/{}.py".format(TEMP_DIR, filename_user_answer)],
-                                            capture_output=True,
-                                            universal_newlines=True)                                             
-    test_output = subprocess.run(["python", "{}/{}.py".format(TEMP_DIR, filename_test_code)],
-                                            capture_output=True,
-                                            universal_newlines=True)
-
-    os.remove("{}/{}.py".format(TEMP_DIR, filename_user_answer))
-    os.remove("{}/{}.py".format(TEMP_DIR, filename_test_code))
-        
-    # error condition
-    if user_output.returncode != 0 or test_output.returncode != 0: # returncode != 0 => error
+    # submit-and-poll mode: grade in the background and send back a job id to poll
+    if req_body.get("async", False) or request.args.get("async", "") == "true":
+        try:
+            job_id = scheduler.submit(writecode_check_correctness, user_answer, test_code)
+        except JobQueueFull:
+            resp = Response("Too many submissions are being graded, try again later",
+                            status=503, mimetype=TEXT_TYPE)
+            return resp
+        status_url = f"/checker/{JOBS}/{job_id}"
+        resp_body = {
+            "jobId": job_id,
+            "statusUrl": status_url
+        }
+        resp = Response(json.dumps(resp_body), status=202, mimetype=JSON_TYPE)
+        resp.headers["Location"] = status_url
+        return resp
+
+    resp_body = writecode_check_correctness(user_answer, test_code)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
+    return resp
+
+
+@app.route(f"/checker/{JOBS}/<job_id>", methods=["GET"])
+@cross_origin()
+def job_status_handler(job_id):
+    """
+    Status of a job submitted in async mode. Responds with 202 and {status: "pending"} until the
+    job is done, then 200 with the same response body the synchronous endpoint would have sent.
+    Results expire ASYNC_JOB_TTL seconds after the job finishes.
+    """
+    job = scheduler.get(job_id)
+    if job is None:
+        resp = Response("No job with that id (it may have expired)",
+                        status=404, mimetype=TEXT_TYPE)
+        return resp
+    if job["status"] == PENDING:
+        resp = Response(json.dumps({"status": PENDING}), status=202, mimetype=JSON_TYPE)
+        return resp
+    if job["status"] == ERROR:
+        resp = Response(f"Error: {job['result']}", status=500, mimetype=TEXT_TYPE)
+        return resp
+    resp = Response(json.dumps(job["result"]), status=200, mimetype=JSON_TYPE)
+    return resp
+
+
+@cached_grading(WRITE_CODE)
+def writecode_check_correctness(user_answer, test_code):
+    """
+    writecode_check_correctness runs the user's code and the test code and compares their output.
+
+    Unlike write_code_run_code, the fail message includes the traceback if the user's code errors.
+    It will return the response body for the message, not the response itself.
+    """
+    # Compare the std output of both programs line by line (as the user's code produces it)
+    user_output, test_output, mismatch = compare_with_reference(user_answer, test_code)
+    if user_output.limit_exceeded is not None:
+        return limit_exceeded_body(user_output)
+
+    # error condition (a user run stopped at the first wrong line doesn't count as an error)
+    if (user_output.returncode != 0 and not user_output.stopped) or test_output.returncode != 0: # returncode != 0 => error
         resp_body = {
             "pass": False,
             "failMessage": "Looks like there is an error in the code you wrote. Here's what the computer said:\n\n`{}`".format(parse_traceback(user_output.stderr)),
             "failMessageFull": "`{}`".format(user_output.stderr)
         }
-        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-        return resp
-    if test_output.stdout == user_output.stdout:
+        return resp_body
+    if mismatch is None:
         resp_body = {
             "pass": True
         }
-        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-        return resp
-    expected, got = ("", "")
-
-    split_user_output = user_output.stdout.split("\n")
-    split_test_output = test_output.stdout.split("\n")
-    for idx, line in enumerate(split_test_output):
-        if split_user_output[idx] != line:
-            expected = line
-            got = split_user_output[idx]
-            break
+        return resp_body
+    expected, got = mismatch
     resp_body = {
         "pass": False,
         "failMessage": "Expected `{}` but got `{}`".format(expected, got)
     }
-    resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-    return resp
+    return resp_body
 
 
 @app.route(f"/checker/{MULTIPLE_CHOICE}", methods=["POST"])
@@ -127,22 +210,29 @@ def multiplechoice_handler():
         return resp
 
     # get request body
-    req_body = request.get_json()
+    with metrics.timed("parse"):
+        req_body = request.get_json()
     user_answer = req_body.get("userAnswer", "")
     expected_answer = req_body.get("expectedAnswer", "")
 
+    resp_body = multiplechoice_check_correctness(user_answer, expected_answer)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
+    return resp
+
+
+def multiplechoice_check_correctness(user_answer, expected_answer):
+    """
+    multiplechoice_check_correctness checks the selected choice is exactly the expected one
+    """
     if expected_answer != user_answer:
-        resp_body = {
+        return {
             "pass": False,
             "failMessage": "Wrong answer selected"
         }
-        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-        return resp
-    resp_body = {
+    return {
         "pass": True
     }
-    resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-    return resp
 
 
 @app.route(f"/checker/{SHORT_ANSWER}", methods=["POST"])
@@ -161,29 +251,35 @@ def shortanswer_handler():
         return resp
 
     # get request body
-    req_body = request.get_json()
+    with metrics.timed("parse"):
+        req_body = request.get_json()
     user_answer = req_body.get("userAnswer", "")
     question_code = req_body.get("questionCode", "")
     expected_answer = req_body.get("expectedAnswer", "")
 
-    if question_code != "":
-        resp_body = fill_blank_run_code(user_answer, question_code)
+    resp_body = shortanswer_check_correctness(user_answer, expected_answer, question_code)
+    with metrics.timed("encode"):
         resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-        return resp
+    return resp
+
+
+@cached_grading(SHORT_ANSWER)
+def shortanswer_check_correctness(user_answer, expected_answer, question_code=""):
+    """
+    shortanswer_check_correctness compares the user's answer to the output of question_code if
+    there is any, otherwise to expected_answer
+    """
+    if question_code != "":
+        return fill_blank_run_code(user_answer, question_code)
 
     if parse_response(user_answer) != parse_response(expected_answer):
-        resp_body = {
+        return {
             "pass": False,
             "failMessage": "Expected `{}` but got `{}`".format(expected_answer, user_answer)
         }
-        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-        return resp
-
-    resp_body = {
+    return {
         "pass": True
     }
-    resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
-    return resp
 
 
 @app.route(f"/checker/{CHECKBOX_QUESTION}", methods=["POST"])
@@ -202,7 +298,8 @@ def checkbox_handler():
         return resp
 
     # get request body
-    req_body = request.get_json()
+    with metrics.timed("parse"):
+        req_body = request.get_json()
     user_answer = req_body.get("userAnswer", None)
     expected_answer = req_body.get("expectedAnswer", None)
 
@@ -213,7 +310,8 @@ def checkbox_handler():
 
     resp_body = checkbox_question_check_correctness(
         expected_answer, user_answer)
-    resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
     return resp
 
 
@@ -233,73 +331,243 @@ def table_handler():
         return resp
 
     # get request body
-    req_body = request.get_json()
+    with metrics.timed("parse"):
+        req_body = request.get_json()
     questions = req_body.get("questions")
     answers = req_body.get("userAnswer")
 
-    results = []
+    with metrics.timed("grade"):
+        results = grade_table(questions, answers)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps(results), status=200, mimetype=JSON_TYPE)
+    return resp
+
+
+def grade_table(questions, answers):
+    """
+    grade_table grades every cell of a table question and returns the results in the same
+    row/column shape as questions.
+
+    Cells that run code are graded concurrently (see grade_concurrently). All other cells are cheap
+    and graded inline.
+    """
+    results = [[None] * len(question_row) for question_row in questions]
+    code_cells = []
     # iterate through each row and col of the questions/answers
     for i, question_row in enumerate(questions):
-        results.append([])
-        # https://stackoverflow.com/questions/2905965/creating-threads-in-python
-        # TODO: Multithread this to make it more performant (not necessary unless app grows a ton)
         for j, question in enumerate(question_row):
-            if question["type"] == FILL_BLANK:
-                user_answer = answers[i][j]
-                if question["code"] == "":
-                    actual_answer = question["answer"]
-                    correctness = fill_blank_question_check_correctness(
-                        actual_answer, user_answer)
-                    if correctness:
-                        results[i].append({
-                            "pass": True,
-                        })
-                    else:
-                        results[i].append({
-                            "pass": False,
-                            "failMessage": "Expected `{}` but got `{}`".format(actual_answer,
-                                                                           user_answer)
-                        })
-                else:
-                    ran_code = fill_blank_run_code(
-                        user_answer, question["code"])
-                    results[i].append(ran_code)
-
-            elif question["type"] == MULTIPLE_CHOICE:
-                # MULTIPLE_CHOICE is the same as FILL_BLANK at the moment, but we can change it
-                # in the future to incorporate different functionality
-                actual_answer = question["answer"]
-                user_answer = answers[i][j]
-                correctness = multiple_choice_question_check_correctness(
-                    actual_answer, user_answer)
-                if correctness:
-                    results[i].append({
-                        "pass": True,
-                    })
-                else:
-                    results[i].append({
-                        "pass": False,
-                        "failMessage": "Expected `{}` but got `{}`".format(actual_answer, user_answer)
-                    })
-            elif question["type"] == WRITE_CODE:
-                user_answer = answers[i][j]
-                test_code = question["code"]
-                ran_code = write_code_run_code(user_answer, test_code)
-                results[i].append(ran_code)
-            elif question["type"] == SELECT_MULTIPLE or question["type"] == CHECKBOX_QUESTION:
-                # checkbox questions expect the answer to be in an array of choices
-                user_answer = answers[i][j]
-                actual_answer = question["answer"]
-                results[i].append(checkbox_question_check_correctness(
-                    actual_answer, user_answer))
+            if is_code_cell(question):
+                code_cells.append((i, j))
             else:
-                results[i].append({
-                    "blank": True
-                })
-    resp = Response(json.dumps(results), status=200, mimetype=JSON_TYPE)
+                results[i][j] = grade_table_cell(question, answers, i, j)
+
+    graded = grade_concurrently(
+        [((i, j), grade_table_cell, (questions[i][j], answers, i, j)) for (i, j) in code_cells])
+    for (i, j), result in graded.items():
+        results[i][j] = result
+    return results
+
+
+def grade_concurrently(tasks):
+    """
+    Runs tasks, a list of (key, function, args), on grading_executor and returns a dict of
+    key -> result.
+
+    At most GRADING_CONCURRENCY tasks are in flight at once so that one big request can't take
+    over every thread.
+    """
+    pending_tasks = iter(tasks)
+    futures = {}
+    results = {}
+
+    def submit_next_task():
+        task = next(pending_tasks, None)
+        if task is not None:
+            key, function, args = task
+            futures[grading_executor.submit(metrics.in_request(function), *args)] = key
+
+    for _ in range(GRADING_CONCURRENCY):
+        submit_next_task()
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[futures.pop(future)] = future.result()
+            submit_next_task()
+    return results
+
+
+def is_code_cell(question):
+    """
+    True if grading the table cell requires running code
+    """
+    if question["type"] == FILL_BLANK:
+        return question["code"] != ""
+    return question["type"] == WRITE_CODE
+
+
+def grade_table_cell(question, answers, i, j):
+    """
+    grade_table_cell grades the cell at row i, col j of a table question and returns its result
+    """
+    if question["type"] == FILL_BLANK:
+        user_answer = answers[i][j]
+        if question["code"] == "":
+            actual_answer = question["answer"]
+            correctness = fill_blank_question_check_correctness(
+                actual_answer, user_answer)
+            if correctness:
+                return {
+                    "pass": True,
+                }
+            return {
+                "pass": False,
+                "failMessage": "Expected `{}` but got `{}`".format(actual_answer,
+                                                               user_answer)
+            }
+        return fill_blank_run_code(user_answer, question["code"])
+
+    elif question["type"] == MULTIPLE_CHOICE:
+        # MULTIPLE_CHOICE is the same as FILL_BLANK at the moment, but we can change it
+        # in the future to incorporate different functionality
+        actual_answer = question["answer"]
+        user_answer = answers[i][j]
+        correctness = multiple_choice_question_check_correctness(
+            actual_answer, user_answer)
+        if correctness:
+            return {
+                "pass": True,
+            }
+        return {
+            "pass": False,
+            "failMessage": "Expected `{}` but got `{}`".format(actual_answer, user_answer)
+        }
+    elif question["type"] == WRITE_CODE:
+        user_answer = answers[i][j]
+        test_code = question["code"]
+        return write_code_run_code(user_answer, test_code)
+    elif question["type"] == SELECT_MULTIPLE or question["type"] == CHECKBOX_QUESTION:
+        # checkbox questions expect the answer to be in an array of choices
+        user_answer = answers[i][j]
+        actual_answer = question["answer"]
+        return checkbox_question_check_correctness(
+            actual_answer, user_answer)
+    return {
+        "blank": True
+    }
+
+
+@app.route(f"/checker/{BATCH}", methods=["POST"])
+@cross_origin()
+def batch_handler():
+    """
+    Grades a list of questions of any type in one request. Request body:
+        {
+            jobs: [
+                {
+                    type: string (question type, e.g. "writeCode"),
+                    ...fields the endpoint for that type expects (userAnswer, expectedAnswer, etc.)
+                }
+            ]
+        }
+    Responds with a list of response bodies, in the same order as jobs.
+    """
+    # Make sure is POST request
+    if request.method != "POST":
+        resp = Response("Must be a POST request",
+                        status=405, mimetype=TEXT_TYPE)
+        return resp
+
+    # Make sure is JSON request body
+    if (is_req_not_json_type(request)):
+        resp = Response("Request body must be JSON",
+                        status=415, mimetype=TEXT_TYPE)
+        return resp
+
+    # get request body
+    with metrics.timed("parse"):
+        req_body = request.get_json()
+    jobs = req_body.get("jobs", None)
+    if not isinstance(jobs, list):
+        resp = Response("jobs must be a list",
+                        status=400, mimetype=TEXT_TYPE)
+        return resp
+
+    with metrics.timed("grade"):
+        results = grade_batch(jobs)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps(results), status=200, mimetype=JSON_TYPE)
     return resp
 
 
+def grade_batch(jobs):
+    """
+    grade_batch grades every job and returns the results in the same order as jobs.
+
+    Jobs that run code are graded concurrently (see grade_concurrently). Tables are graded inline
+    because grade_table already grades its code cells concurrently. All other jobs are cheap and
+    graded inline.
+    """
+    results = [None] * len(jobs)
+    code_jobs = []
+    for idx, job in enumerate(jobs):
+        if is_code_job(job):
+            code_jobs.append(idx)
+        else:
+            results[idx] = grade_batch_job(job)
+
+    graded = grade_concurrently([(idx, grade_batch_job, (jobs[idx],)) for idx in code_jobs])
+    for idx, result in graded.items():
+        results[idx] = result
+    return results
+
+
+def is_code_job(job):
+    """
+    True if grading the batch job requires running code
+    """
+    if not isinstance(job, dict):
+        return False
+    if job.get("type") == WRITE_CODE:
+        return True
+    if job.get("type") in (SHORT_ANSWER, FILL_BLANK):
+        return job.get("questionCode", "") != ""
+    return False
+
+
+def grade_batch_job(job):
+    """
+    grade_batch_job grades one batch job with the same function its single-question endpoint
+    uses. Jobs that can't be graded get {"error": message} instead of a response body.
+    """
+    if not isinstance(job, dict):
+        return {"error": "Job must be an object"}
+    question_type = job.get("type", None)
+    try:
+        if question_type == WRITE_CODE:
+            return writecode_check_correctness(job.get("userAnswer", ""), job.get("testCode", ""))
+        elif question_type == MULTIPLE_CHOICE:
+            return multiplechoice_check_correctness(job.get("userAnswer", ""),
+                                                    job.get("expectedAnswer", ""))
+        elif question_type == SHORT_ANSWER or question_type == FILL_BLANK:
+            return shortanswer_check_correctness(job.get("userAnswer", ""),
+                                                 job.get("expectedAnswer", ""),
+                                                 job.get("questionCode", ""))
+        elif question_type == CHECKBOX_QUESTION or question_type == SELECT_MULTIPLE:
+            user_answer = job.get("userAnswer", None)
+            expected_answer = job.get("expectedAnswer", None)
+            if user_answer is None or expected_answer is None:
+                return {"error": "An error occurred when decoding question"}
+            return checkbox_question_check_correctness(expected_answer, user_answer)
+        elif question_type == MEMORY_TABLE:
+            return memorytable_check_correctness(job.get("userAnswer", ""),
+                                                 job.get("expectedAnswer", ""))
+        elif question_type == TABLE:
+            return grade_table(job.get("questions"), job.get("userAnswer"))
+    except Exception as exc:
+        return {"error": f"Error: {exc}"}
+    return {"error": f"Unknown question type {question_type}"}
+
+
 def checkbox_question_check_correctness(actual_answer, user_answer):
     """
     checkbox_question_check_correctness compares the actual checkbox answer to the user's answer
@@ -363,32 +631,15 @@ def fill_blank_run_code(user_answer, test_code):
 
     It will return the response body for the message, not the response itself. 
     """
-    # Create random hashes for each temp file for no overlap
-    filename_test_code = secrets.token_urlsafe(16)
-
-    # Put code into those temp files
-    file_test_code = open("{}/{}.py".format(TEMP_DIR, filename_test_code), "w")
-    file_test_code.write(test_code)
-
-    # Close the files
-    file_test_code.close()
-
-    # Check the std output of all files
-    test_output = ""
-    try: # TODO: change this to use subprocess.run() (like writecode_handler)
-        test_output = subprocess.check_output(["python", "{}/{}.py".format(TEMP_DIR, filename_test_code)],
-                                              universal_newlines=True)
-
-        # remove the files
-        os.remove("{}/{}.py".format(TEMP_DIR, filename_test_code))
-    except subprocess.CalledProcessError as exc:
-        # if there is an error, remove the files and then fail because of an error
-        os.remove("{}/{}.py".format(TEMP_DIR, filename_test_code))
+    # Check the std output of the test code
+    test_output = run_reference_code(test_code)
+    if test_output.returncode != 0:
         resp_body = {
             "pass": False,
             "failMessage": "Unable to compile code. E2"
         }
         return resp_body
+    test_output = test_output.stdout
     if test_output == user_answer:
         resp_body = {
             "pass": True
@@ -425,12 +676,14 @@ def memorytable_handler():
         return resp
 
     # Get request body
-    req_body = request.get_json()
+    with metrics.timed("parse"):
+        req_body = request.get_json()
     user_answer = req_body.get("userAnswer", "")
     expected_answer = req_body.get("expectedAnswer", "")
 
     resp_body = memorytable_check_correctness(user_answer, expected_answer)
-    resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
+    with metrics.timed("encode"):
+        resp = Response(json.dumps(resp_body), status=200, mimetype=JSON_TYPE)
     return resp
 
 
@@ -466,54 +719,22 @@ def memorytable_check_correctness(user_answer, expected_answer):
     }
 
 def write_code_run_code(user_answer, test_code):
-    # Create random hashes for each temp file for no overlap
-    filename_user_answer = secrets.token_urlsafe(16)
-    filename_test_code = secrets.token_urlsafe(16)
-
-    # Put code into those temp files
-    file_user_answer = open("{}/{}.py".format(TEMP_DIR, filename_user_answer), "w")
-    file_test_code = open("{}/{}.py".format(TEMP_DIR, filename_test_code), "w")
-    file_user_answer.write(user_answer)
-    file_test_code.write(test_code)
-
-    # Close the files
-    file_user_answer.close()
-    file_test_code.close()
-
-    # Check the std output of all files
-    user_output = ""
-    test_output = ""
-    try: # TODO: change this to use subprocess.run() (like writecode_handler)
-        user_output = subprocess.check_output(["python", "{}/{}.py".format(TEMP_DIR, filename_user_answer)],
-                                              universal_newlines=True)
-        test_output = subprocess.check_output(["python", "{}/{}.py".format(TEMP_DIR, filename_test_code)],
-                                              universal_newlines=True)
-
-        # remove the files
-        os.remove("{}/{}.py".format(TEMP_DIR, filename_user_answer))
-        os.remove("{}/{}.py".format(TEMP_DIR, filename_test_code))
-    except subprocess.CalledProcessError as exc:
-        # if there is an error, remove the files and then fail because of an error
-        os.remove("{}/{}.py".format(TEMP_DIR, filename_user_answer))
-        os.remove("{}/{}.py".format(TEMP_DIR, filename_test_code))
+    # Compare the std output of both programs line by line (as the user's code produces it)
+    user_output, test_output, mismatch = compare_with_reference(user_answer, test_code)
+    if user_output.limit_exceeded is not None:
+        return limit_exceeded_body(user_output)
+    if (user_output.returncode != 0 and not user_output.stopped) or test_output.returncode != 0:
         resp_body = {
             "pass": False,
             "failMessage": "Unable to compile code. E3"
         }
         return resp_body
-    if test_output == user_output:
+    if mismatch is None:
         resp_body = {
             "pass": True
         }
         return resp_body
-    expected, got = ("", "")
-    split_user_output = user_output.split("\n")
-    split_test_output = test_output.split("\n")
-    for idx, line in enumerate(split_test_output):
-        if split_user_output[idx] != line:
-            expected = line
-            got = split_user_output[idx]
-            break
+    expected, got = mismatch
     resp_body = {
         "pass": False,
         "failMessage": "Expected {} but got {}".format(expected, got)
@@ -521,106 +742,45 @@ def write_code_run_code(user_answer, test_code):
     return resp_body
 
 
-def is_req_not_json_type(request):
-    return request.headers.get("Content-Type") != JSON_TYPE
-
-
-@app.route("/bkt", methods=["POST"])
+@app.route(f"/checker/{CACHE_STATS}", methods=["GET"])
 @cross_origin()
-def bkt_handler(NUM_TOP_RECS=2, NUM_RELATED_RECS=2):
+def cache_stats_handler():
     """
-    NUM_TOP_RECS: Number of recommendations
-    NUM_RELATED_RECS: Number of recommendations to get from related concepts (from target, its child or parents)
+    Hit/miss counters for the grading result cache (see cached_grading), for tuning
+    GRADING_CACHE_SIZE and GRADING_CACHE_TTL
     """
-    # Make sure is POST request
-    if request.method != "POST":
-        resp = Response("Must be a POST request",
-                        status=405, mimetype=TEXT_TYPE)
-        return resp
-
-    # Make sure is JSON request body
-    if is_req_not_json_type(request):
-        resp = Response("Request body must be JSON",
-                        status=415, mimetype=TEXT_TYPE)
-        return resp
-
-    # get request body
-    req_body = request.get_json()
-
-    is_correct = req_body.get("isCorrect", None)
-    read_or_write = req_body.get("readOrWrite", None)
-    eid = req_body.get("exerciseID", None)
-    transfer = req_body.get("transfer", None)
-    item_params = req_body.get("itemParams", None)
-    target_concept = req_body.get("targetConcept", None)
-    concept_map = req_body.get("conceptMap", None)
-    
-    item_params_df = None
-    try:
-        item_params_df = convert_item_params_to_dataframe(item_params)
-    except Exception as exc:
-        resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
-        return resp
-    prior_pknown = req_body.get("priorPknown", None)
-    exercise_ids = req_body.get("exerciseIDs", None)
-
-    if (is_correct is None) or (eid is None) \
-            or (transfer is None) or (item_params_df is None) \
-            or (prior_pknown is None) or (exercise_ids is None) \
-            or (read_or_write is None) or (concept_map is None) \
-            or (target_concept is None):
-        resp = Response("You are missing a field",
-                        status=400, mimetype=TEXT_TYPE)
-        return resp
+    resp = Response(json.dumps(grading_cache.stats()), status=200, mimetype=JSON_TYPE)
+    return resp
 
-    pk_new = None
-    try:
-        pk_new = posterior_pknown(
-            is_correct, eid, transfer, item_params_df, prior_pknown)
-    except Exception as exc:
-        resp = Response(f"Error: {exc}", status=400, mimetype=TEXT_TYPE)
-        return resp
 
-    # TODO: This may be returned as an un-serializable object (Series), will have to
-    # call a function to convert to list if so
-    df_ordered = order_next_questions(exercise_ids, pk_new, item_params)
-    
-    # get eids for exercises to recommend (getting recommendations based on hierarchical relationship)
-    eid_related = filter_ordered_questions_by_concepts(df_ordered[EID], item_params, target_concept, concept_map)
-    eid_top_n = df_ordered.reset_index().iloc[range(0,NUM_TOP_RECS), :] # get top recs overall
-
-    rec_eids = list(eid_top_n[EID]) + eid_related[0:NUM_RELATED_RECS] # merge list of eids that are top N, top N related to concept
-    rec_eids = list(dict.fromkeys(rec_eids)) # remove duplicates
-    
-    df_ordered = df_ordered[df_ordered[EID].isin(rec_eids)]
-
-    results = {
-        "pkNew": pk_new,
-        "exerciseInfo": df_ordered.reset_index().to_json(),
-        "suggestedExercises": list(df_ordered[EID]) # don't actually need to pass this (b/c included in exerciseInfo), but convinent & reverse-compatiable
-    }
-    resp = Response(json.dumps(results), status=200, mimetype=JSON_TYPE)
-    # print("pk changed from {} to {} (change of {})".format(prior_pknown, pk_new, (pk_new - prior_pknown))) # TODO remove
+@app.route(f"/{METRICS}", methods=["GET"])
+def metrics_handler():
+    """
+    Request latencies, stage timings, subprocess, run limit and cache counters of this process, in
+    the Prometheus text format
+    """
+    resp = Response(metrics.registry.render(), status=200, mimetype="text/plain; version=0.0.4")
     return resp
 
 
-def convert_item_params_to_dataframe(item_params):
+def limit_exceeded_body(run_result):
     """
-    item_params is json array:
-        [
-            {
-                eid: string,
-                slip: float,
-                guess: float,
-                concept: string,
-            }
-        ]
-
-    returns pandas representation of this json array
+    limit_exceeded_body returns the response body for user code that was stopped because it hit
+    one of the RUN_LIMITS (e.g. an infinite loop)
     """
-    for item in item_params:
-        if len(item) != 4:
-            raise ValueError("Invalid item params provided")
-        if ("eid" not in item) or ("slip" not in item) or ("guess" not in item) or ("concept" not in item):
-            raise ValueError("Invalid item params provided")
-    return pd.DataFrame(item_params)
+    messages = {
+        LIMIT_TIMEOUT: "Your code took longer than {} seconds to run. Check for infinite loops.".format(
+            RUN_LIMITS["timeout"]),
+        LIMIT_CPU: "Your code used too much processing time. Check for infinite loops.",
+        LIMIT_MEMORY: "Your code used too much memory.",
+        LIMIT_OUTPUT: "Your code printed too much output. Check for infinite loops."
+    }
+    return {
+        "pass": False,
+        "limitExceeded": run_result.limit_exceeded,
+        "failMessage": messages.get(run_result.limit_exceeded, "Your code was stopped early.")
+    }
+
+
+def is_req_not_json_type(request):
+    return request.headers.get("Content-Type") != JSON_TYPE
@@ -0,0 +1,350 @@
+"""
+Long-lived python interpreter used by the worker pool (see worker_pool.py).
+
+This file is run as a script by the pool. It pre-imports the modules that submissions commonly
+use and then waits for jobs. Every job runs in a forked child, so submitted code always starts from
+a clean copy of this interpreter and cannot leave state behind for the next submission. It only
+uses the standard library so execution.py can also import its sandboxing helpers.
+
+Protocol (one JSON object per line):
+    request:  {"op": "ping"}
+    response: {"ok": true, "pid": int}
+    request:  {"op": "run", "source": str, "limits": {"timeout": float, "cpu": int, "memory": int, "output": int}}
+    response: {"returncode": int, "stdout": str, "stderr": str, "limitExceeded": str or null}
+    request:  {"op": "stream", "source": str, "limits": {...}}
+    responses: {"event": "start", "pid": int}, then {"event": "stdout", "data": str} as output is
+               produced, then {"event": "exit", ...same fields as run, with stdout ""}
+
+Limits are the wall-clock seconds, CPU seconds, address space bytes and captured output bytes
+(stdout + stderr) a job may use. A missing or 0 limit is not enforced.
+"""
+import builtins
+import codecs
+import importlib
+import io
+import json
+import linecache
+import os
+import selectors
+import signal
+import sys
+import time
+import traceback
+import types
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# matches the temp dir submissions used to be written to, so sys.path[0] looks the same as before
+SCRIPT_DIR = "/tmp"
+SCRIPT_NAME = os.path.join(SCRIPT_DIR, "main.py")
+PRELOAD_MODULES = os.environ.get("WORKER_PRELOAD_MODULES",
+                                 "math,random,string,re,json,collections,itertools,functools")
+
+READ_SIZE = 65536
+
+# reasons a job was stopped early (limitExceeded)
+LIMIT_TIMEOUT = "timeout"
+LIMIT_CPU = "cpu"
+LIMIT_MEMORY = "memory"
+LIMIT_OUTPUT = "output"
+
+
+def preload_modules():
+    for name in PRELOAD_MODULES.split(","):
+        name = name.strip()
+        if name == "":
+            continue
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def exit_code_from_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def decode_output(data):
+    """
+    Decode output the way subprocess does with universal_newlines=True
+    """
+    text = data.decode("utf-8", errors="replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def apply_limits(limits):
+    """
+    Puts the current process in its own process group and applies the CPU and memory limits.
+    Must be called in the child process before the submitted code runs.
+    """
+    os.setsid()
+    if resource is None:
+        return
+    cpu = limits.get("cpu")
+    if cpu:
+        # SIGXCPU at the soft limit, SIGKILL a second later if it is caught
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    memory = limits.get("memory")
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def get_deadline(limits):
+    timeout = limits.get("timeout")
+    return time.monotonic() + timeout if timeout else None
+
+
+class OutputReader:
+    """
+    Reads stdout and stderr of process group pid until both close, killing the group if it runs
+    past deadline (a time.monotonic() value) or prints more than output_limit bytes in total.
+
+    stdout is handed out in chunks by stdout_chunks() as it arrives. stderr is kept in stderr and
+    the limit that stopped the process (if any) in limit_exceeded.
+    """
+
+    def __init__(self, pid, out_fd, err_fd, deadline, output_limit):
+        self.pid = pid
+        self.out_fd = out_fd
+        self.err_fd = err_fd
+        self.deadline = deadline
+        self.output_limit = output_limit
+        self.output_bytes = 0
+        self.stderr_chunks = []
+        self.limit_exceeded = None
+
+    @property
+    def stderr(self):
+        return b"".join(self.stderr_chunks)
+
+    def stdout_chunks(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.out_fd, selectors.EVENT_READ)
+        selector.register(self.err_fd, selectors.EVENT_READ)
+        open_fds = 2
+        try:
+            while open_fds > 0 and self.limit_exceeded is None:
+                remaining = None
+                if self.deadline is not None:
+                    remaining = self.deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.limit_exceeded = LIMIT_TIMEOUT
+                        break
+                for key, _ in selector.select(remaining):
+                    data = os.read(key.fd, READ_SIZE)
+                    if not data:
+                        selector.unregister(key.fd)
+                        open_fds -= 1
+                        continue
+                    if self.output_limit and self.output_bytes + len(data) > self.output_limit:
+                        data = data[:self.output_limit - self.output_bytes]
+                        self.limit_exceeded = LIMIT_OUTPUT
+                    self.output_bytes += len(data)
+                    if key.fd == self.err_fd:
+                        self.stderr_chunks.append(data)
+                    elif data:
+                        yield data
+                    if self.limit_exceeded is not None:
+                        break
+        finally:
+            selector.close()
+            if self.limit_exceeded is not None:
+                kill_group(self.pid)
+
+
+def stream_decoder():
+    """
+    Incremental version of decode_output for text that arrives in chunks
+    """
+    return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(errors="replace"),
+                                        translate=True)
+
+
+def wait_for_exit(pid, deadline):
+    """
+    Waits for pid to exit, killing its process group if it is still running at deadline.
+    Returns (wait status, True if it was killed)
+    """
+    while True:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+        if waited_pid != 0:
+            return status, False
+        if deadline is not None and time.monotonic() >= deadline:
+            kill_group(pid)
+            _, status = os.waitpid(pid, 0)
+            return status, True
+        time.sleep(0.002)
+
+
+def detect_limit_exceeded(returncode, stderr, limits):
+    """
+    Works out which rlimit (if any) stopped a process from how it exited
+    """
+    if limits.get("cpu") and returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+        return LIMIT_CPU
+    if limits.get("memory") and stderr.rstrip().split("\n")[-1].startswith("MemoryError"):
+        return LIMIT_MEMORY
+    return None
+
+
+def exec_source(source):
+    """
+    Runs source as if it were `python main.py`. Only ever called in a forked child; never returns.
+    """
+    sys.argv = [SCRIPT_NAME]
+    sys.path[0] = SCRIPT_DIR
+    if "random" in sys.modules:
+        # children would otherwise all share the pool worker's random state
+        sys.modules["random"].seed()
+
+    main_module = types.ModuleType("__main__")
+    main_module.__file__ = SCRIPT_NAME
+    main_module.__builtins__ = builtins
+    sys.modules["__main__"] = main_module
+    # lets tracebacks show the offending line even though there is no file on disk
+    linecache.cache[SCRIPT_NAME] = (len(source), None, source.splitlines(True), SCRIPT_NAME)
+
+    exit_code = 0
+    try:
+        code = compile(source, SCRIPT_NAME, "exec")
+        exec(code, main_module.__dict__)
+    except SystemExit as exc:
+        if exc.code is None:
+            exit_code = 0
+        elif isinstance(exc.code, int):
+            exit_code = exc.code
+        else:
+            print(exc.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        # drop this frame so the traceback starts at the submitted code
+        traceback.print_exception(etype, value, tb.tb_next)
+        exit_code = 1
+
+    try:
+        import atexit
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code & 0xFF)
+
+
+def fork_job(source, limits, control_fd):
+    """
+    Fork a child to run source under limits. Returns (pid, stdout read fd, stderr read fd)
+    """
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_w, 1)
+        os.dup2(err_w, 2)
+        for fd in (devnull, out_r, out_w, err_r, err_w, control_fd):
+            os.close(fd)
+        apply_limits(limits)
+        exec_source(source)
+
+    os.close(out_w)
+    os.close(err_w)
+    return pid, out_r, err_r
+
+
+def finish_job(pid, reader, limits, stdout=""):
+    """
+    Waits for a job whose output has been read by reader and returns its response
+    """
+    os.close(reader.out_fd)
+    os.close(reader.err_fd)
+    # the output pipes can close before the process exits, so the deadline still applies here
+    status, killed = wait_for_exit(pid, reader.deadline)
+    limit_exceeded = reader.limit_exceeded
+    if killed and limit_exceeded is None:
+        limit_exceeded = LIMIT_TIMEOUT
+
+    returncode = exit_code_from_status(status)
+    stderr = decode_output(reader.stderr)
+    if limit_exceeded is None:
+        limit_exceeded = detect_limit_exceeded(returncode, stderr, limits)
+    return {
+        "returncode": returncode,
+        "stdout": stdout,
+        "stderr": stderr,
+        "limitExceeded": limit_exceeded
+    }
+
+
+def run_job(source, limits, control_fd):
+    """
+    Run source under limits and collect its output and exit code
+    """
+    pid, out_r, err_r = fork_job(source, limits, control_fd)
+    reader = OutputReader(pid, out_r, err_r, get_deadline(limits), limits.get("output"))
+    stdout = b"".join(reader.stdout_chunks())
+    return finish_job(pid, reader, limits, decode_output(stdout))
+
+
+def stream_job(source, limits, control_fd, send):
+    """
+    Run source under limits, calling send with each message of the stream op as the job runs.
+    The job's process group id is sent first so the client can stop the job early.
+    """
+    pid, out_r, err_r = fork_job(source, limits, control_fd)
+    send({"event": "start", "pid": pid})
+    reader = OutputReader(pid, out_r, err_r, get_deadline(limits), limits.get("output"))
+    decoder = stream_decoder()
+    for chunk in reader.stdout_chunks():
+        text = decoder.decode(chunk)
+        if text:
+            send({"event": "stdout", "data": text})
+    text = decoder.decode(b"", final=True)
+    if text:
+        send({"event": "stdout", "data": text})
+    response = finish_job(pid, reader, limits)
+    response["event"] = "exit"
+    send(response)
+
+
+def main():
+    preload_modules()
+
+    # keep the original stdout for responses so stray prints can't corrupt the protocol
+    control_fd = os.dup(1)
+    control = os.fdopen(control_fd, "w")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    def send(response):
+        control.write(json.dumps(response) + "\n")
+        control.flush()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        op = request.get("op")
+        if op == "ping":
+            send({"ok": True, "pid": os.getpid()})
+        elif op == "run":
+            send(run_job(request.get("source", ""), request.get("limits", {}), control_fd))
+        elif op == "stream":
+            stream_job(request.get("source", ""), request.get("limits", {}), control_fd, send)
+        else:
+            send({"error": "Unknown op {}".format(op)})
+
+
+if __name__ == "__main__":
+    main()
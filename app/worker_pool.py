@@ -0,0 +1,203 @@
+"""
+Pool of pre-started python interpreters used to run submitted code without paying for interpreter
+startup on every request. Each pooled worker runs worker.py, which forks a fresh child per job.
+
+Configuration (environment variables):
+    WORKER_POOL_SIZE: number of warm workers per web process (0 disables the pool)
+    WORKER_MAX_JOBS: jobs a worker runs before it is replaced
+    WORKER_HEALTH_CHECK_INTERVAL: seconds a worker can sit idle before it is pinged on checkout
+    WORKER_ACQUIRE_TIMEOUT: seconds to wait for a free worker before giving up
+"""
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+
+POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", 4))
+MAX_JOBS_PER_WORKER = int(os.environ.get("WORKER_MAX_JOBS", 100))
+HEALTH_CHECK_INTERVAL = float(os.environ.get("WORKER_HEALTH_CHECK_INTERVAL", 30))
+ACQUIRE_TIMEOUT = float(os.environ.get("WORKER_ACQUIRE_TIMEOUT", 5))
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+
+class WorkerError(Exception):
+    """
+    Raised when a pooled worker dies or stops speaking the protocol
+    """
+    pass
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no worker becomes free within the acquire timeout
+    """
+    pass
+
+
+class Worker:
+    """
+    A single pre-started interpreter running worker.py
+    """
+
+    def __init__(self, python):
+        self.process = subprocess.Popen([python, WORKER_SCRIPT],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        self.jobs = 0
+        self.last_used = time.monotonic()
+
+    def request(self, payload):
+        self.send(payload)
+        return self.receive()
+
+    def send(self, payload):
+        try:
+            self.process.stdin.write(json.dumps(payload) + "\n")
+            self.process.stdin.flush()
+        except (OSError, ValueError) as exc:
+            raise WorkerError("Worker {} failed: {}".format(self.process.pid, exc))
+
+    def receive(self):
+        try:
+            line = self.process.stdout.readline()
+        except (OSError, ValueError) as exc:
+            raise WorkerError("Worker {} failed: {}".format(self.process.pid, exc))
+        if not line:
+            raise WorkerError("Worker {} exited".format(self.process.pid))
+        self.last_used = time.monotonic()
+        return json.loads(line)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def is_healthy(self):
+        """
+        Cheap liveness check; only round-trips a ping if the worker has been idle for a while
+        """
+        if not self.is_alive():
+            return False
+        if time.monotonic() - self.last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            return self.request({"op": "ping"}).get("ok", False)
+        except WorkerError:
+            return False
+
+    def close(self):
+        if not self.is_alive():
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of workers. A worker is checked out for one job at a time and replaced once it
+    has run max_jobs jobs, fails a health check, or dies.
+    """
+
+    def __init__(self, python, size=POOL_SIZE, max_jobs=MAX_JOBS_PER_WORKER,
+                 acquire_timeout=ACQUIRE_TIMEOUT):
+        self.python = python
+        self.size = size
+        self.max_jobs = max_jobs
+        self.acquire_timeout = acquire_timeout
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(Worker(python))
+
+    def run(self, source, limits=None):
+        """
+        Run source on a pooled worker under limits (see worker.py) and return the worker's
+        response: {returncode, stdout, stderr, limitExceeded}
+        """
+        worker = self._acquire()
+        try:
+            result = worker.request({"op": "run", "source": source, "limits": limits or {}})
+        except WorkerError:
+            worker.close()
+            self._idle.put(Worker(self.python))
+            raise
+        worker.jobs += 1
+        self._release(worker)
+        return result
+
+    def stream(self, source, limits=None):
+        """
+        Generator version of run that yields the worker's messages as the job runs (see the
+        stream op in worker.py), ending with the {"event": "exit"} message.
+
+        Callers that stop iterating early must first kill the job's process group (its pid is in
+        the first message); the worker is then replaced rather than reused.
+        """
+        worker = self._acquire()
+        finished = False
+        try:
+            worker.send({"op": "stream", "source": source, "limits": limits or {}})
+            while not finished:
+                message = worker.receive()
+                finished = message.get("event") == "exit"
+                yield message
+        finally:
+            if finished:
+                worker.jobs += 1
+                self._release(worker)
+            else:
+                worker.close()
+                self._idle.put(Worker(self.python))
+
+    def _acquire(self):
+        try:
+            worker = self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            raise PoolExhausted("No worker free after {}s".format(self.acquire_timeout))
+        if not worker.is_healthy():
+            worker.close()
+            worker = Worker(self.python)
+        return worker
+
+    def _release(self, worker):
+        if worker.jobs >= self.max_jobs or not worker.is_alive():
+            worker.close()
+            worker = Worker(self.python)
+        self._idle.put(worker)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(python):
+    """
+    Returns this process's pool, starting it on first use. Returns None if the pool is disabled.
+
+    The pool is created lazily and per pid so that workers are never shared across a fork
+    (e.g. gunicorn --preload).
+    """
+    global _pool, _pool_pid
+    if POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = WorkerPool(python)
+            _pool_pid = os.getpid()
+    return _pool
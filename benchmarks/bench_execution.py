@@ -0,0 +1,58 @@
+"""
+Compares the ways app.execution can run submitted code: a new interpreter fed from a temp file
+(the original TEMP_DIR behaviour), a new interpreter fed through stdin, and the warm worker pool.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_execution [--runs N]
+"""
+import argparse
+import statistics
+import time
+
+from app import execution
+
+PROGRAMS = {
+    "hello": 'print("hello world")',
+    "loop": "total = 0\nfor i in range(10000):\n    total += i\nprint(total)",
+    "imports": "import math, random, collections\nprint(math.sqrt(16))",
+}
+
+
+def time_runs(run, source, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(source)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=30, help="runs per program and mode")
+    args = parser.parse_args()
+
+    pool = execution.get_pool(execution.PYTHON)
+    modes = [
+        (execution.TEMPFILE_MODE, execution.run_code_from_file),
+        (execution.STDIN_MODE, execution.run_code_from_stdin),
+    ]
+    if pool is not None:
+        pool.run("pass") # make sure the workers are up before timing
+        modes.append((execution.POOL_MODE, pool.run))
+
+    print("{:<10} {:<10} {:>10} {:>10} {:>10}".format("program", "mode", "mean ms", "p50 ms", "max ms"))
+    for name, source in PROGRAMS.items():
+        for mode, run in modes:
+            timings = time_runs(run, source, args.runs)
+            print("{:<10} {:<10} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name, mode,
+                statistics.mean(timings) * 1000,
+                statistics.median(timings) * 1000,
+                max(timings) * 1000))
+    if pool is not None:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
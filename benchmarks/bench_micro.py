@@ -0,0 +1,256 @@
+"""
+Microbenchmarks for the BKT and checker hot paths: posterior_pknown, order_next_questions,
+filter_ordered_questions_by_concepts, parse_response and the subprocess helpers in app.execution.
+
+The BKT functions run over synthetic item banks and concept maps of every combination of
+--exercises and --concepts. The banks are generated offline from example_data: slip and guess are
+resampled from example_bkt_data.json's item params, concept maps get about as many edges per
+concept as its concept map, and parse_response runs over the answers in
+_example_table_resp.json. Everything is seeded, so two runs time the same inputs.
+
+Each benchmark reports the time per call (median and best of --repeat timed batches) and, from a
+separate traced call, the peak and retained memory allocated by one call (tracemalloc). Results
+are saved as JSON (default benchmarks/results/<commit>.json); pass an earlier file to --compare
+to print the ratio of each timing to it.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_micro [--exercises N,N,...] [--concepts N,N,...] [--repeat N]
+                                     [--no-subprocess] [--out FILE] [--compare FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from app import execution
+from app.bkt import (as_item_param_store, posterior_pknown, order_next_questions, rank_next_questions,
+                     filter_ordered_questions_by_concepts, CONCEPTS_STR, ADJ_MAT_STR,
+                     EID, SLIP, GUESS, CONCEPT)
+from app.helpers import parse_response, parse_traceback
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example_data")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# timed batches are made at least this long, so timer resolution doesn't matter
+MIN_BATCH_SECONDS = 0.02
+
+TRACEBACK = """Traceback (most recent call last):
+  File "main.py", line 3, in <module>
+    print(total / count)
+ZeroDivisionError: division by zero
+"""
+
+PROGRAM = "total = 0\nfor i in range(1000):\n    total += i\nprint(total)"
+
+
+def load_example(name):
+    with open(os.path.join(EXAMPLE_DIR, name)) as example_file:
+        return json.load(example_file)
+
+
+def synthetic_bank(example, exercises, concepts, seed=0):
+    """
+    Returns (item_params, concept_map): exercises items spread over concepts, with slip and guess
+    resampled from the example's item params and about as many parent -> child edges per concept
+    as the example's concept map (always from an earlier concept to a later one, so no cycles)
+    """
+    rng = np.random.RandomState(seed)
+    example_params = pd.DataFrame(example["itemParams"])
+    example_map = example["conceptMap"]
+    names = list(example_map[CONCEPTS_STR])
+    names = (names + ["concept{}".format(i) for i in range(len(names), concepts)])[:concepts]
+    edges_per_concept = np.sum(example_map[ADJ_MAT_STR]) / len(example_map[CONCEPTS_STR])
+
+    adj_mat = np.zeros((concepts, concepts), dtype=int)
+    if concepts > 1:
+        num_edges = int(round(edges_per_concept * concepts))
+        parents = rng.randint(0, concepts - 1, num_edges)
+        children = parents + 1 + (rng.random_sample(num_edges) * (concepts - 1 - parents)).astype(int)
+        adj_mat[parents, children] = 1
+
+    rows = rng.randint(0, len(example_params), exercises)
+    item_params = pd.DataFrame({
+        EID: ["-bench{:06d}".format(i) for i in range(exercises)],
+        SLIP: example_params[SLIP].values[rows],
+        GUESS: example_params[GUESS].values[rows],
+        CONCEPT: np.array(names, dtype=object)[rng.randint(0, concepts, exercises)],
+    })
+    return item_params, {CONCEPTS_STR: names, ADJ_MAT_STR: adj_mat.tolist()}
+
+
+def time_per_call(function, repeat):
+    """
+    (median, best) seconds per call of function over repeat batches
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < MIN_BATCH_SECONDS and number < 1 << 20:
+        number *= 2
+    timings = sorted(batch / number for batch in timer.repeat(repeat, number))
+    return timings[len(timings) // 2], timings[0]
+
+
+def allocations(function):
+    """
+    (peak, retained) bytes allocated by one call of function
+    """
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = function()
+        current, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak - before, current - before
+
+
+def bkt_benchmarks(example, exercises, concepts):
+    """
+    [(name, function)] for the BKT functions on a bank of this size, called as bkt_handler does
+    """
+    item_params, concept_map = synthetic_bank(example, exercises, concepts)
+    store = as_item_param_store(item_params)
+    exercise_ids = list(item_params[EID])
+    eid = exercise_ids[len(exercise_ids) // 2]
+    target = concept_map[CONCEPTS_STR][len(concept_map[CONCEPTS_STR]) // 2]
+    ordered = list(order_next_questions(exercise_ids, 0.4, store)[EID])
+    return [
+        ("posterior_pknown", lambda: posterior_pknown(True, eid, 0.3, store, 0.33)),
+        ("posterior_pknown[dataframe]", lambda: posterior_pknown(True, eid, 0.3, item_params, 0.33)),
+        ("order_next_questions", lambda: order_next_questions(exercise_ids, 0.4, store)),
+        ("rank_next_questions", lambda: rank_next_questions(exercise_ids, 0.4, store)),
+        ("filter_ordered_questions_by_concepts",
+         lambda: filter_ordered_questions_by_concepts(ordered, store, target, concept_map)),
+    ]
+
+
+def checker_benchmarks(table):
+    """
+    [(name, function)] for the checker helpers, on the example table answers
+    """
+    answers = [answer for row in table["userAnswer"] for answer in row]
+    return [
+        ("parse_response[table]", lambda: [parse_response(answer) for answer in answers]),
+        ("parse_traceback", lambda: parse_traceback(TRACEBACK)),
+    ]
+
+
+def subprocess_benchmarks():
+    """
+    [(name, function)] for running a short program with each of the app.execution helpers
+    """
+    benchmarks = [
+        ("run_code_from_stdin", lambda: execution.run_code_from_stdin(PROGRAM)),
+        ("run_code_from_file", lambda: execution.run_code_from_file(PROGRAM)),
+    ]
+    pool = execution.get_pool(execution.PYTHON)
+    if pool is not None:
+        pool.run("pass") # make sure the workers are up before timing
+        benchmarks.append(("worker_pool.run", lambda: pool.run(PROGRAM, execution.RUN_LIMITS)))
+    return benchmarks
+
+
+def run_benchmark(name, function, repeat, exercises=None, concepts=None):
+    median, best = time_per_call(function, repeat)
+    peak, retained = allocations(function)
+    result = {"benchmark": name, "exercises": exercises, "concepts": concepts,
+              "median_us": median * 1e6, "best_us": best * 1e6,
+              "peak_kb": peak / 1024, "retained_kb": retained / 1024}
+    return result
+
+
+def result_key(result):
+    return (result["benchmark"], result["exercises"], result["concepts"])
+
+
+def git_commit():
+    """
+    (commit hash, whether the working tree has uncommitted changes), or ("unknown", False) outside git
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True, universal_newlines=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def print_result(result, baseline):
+    size = "" if result["exercises"] is None else "{}x{}".format(result["exercises"], result["concepts"])
+    line = "{:<38} {:>11} {:>12.2f} {:>12.2f} {:>10.1f} {:>12.1f}".format(
+        result["benchmark"], size, result["median_us"], result["best_us"], result["peak_kb"], result["retained_kb"])
+    if baseline is not None:
+        base = baseline.get(result_key(result))
+        line += " {:>9}".format("-" if base is None else "{:.2f}x".format(result["median_us"] / base["median_us"]))
+    print(line)
+
+
+def parse_sizes(sizes):
+    return [int(size) for size in sizes.split(",") if size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--exercises", default="10,100,1000,10000", help="comma-separated item bank sizes")
+    parser.add_argument("--concepts", default="5,50,500", help="comma-separated concept map sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="timed batches per benchmark")
+    parser.add_argument("--no-subprocess", action="store_true", help="skip the app.execution benchmarks")
+    parser.add_argument("--out", default=None, help="JSON file to save results to (default: results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare median times with")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = {result_key(result): result for result in json.load(baseline_file)["results"]}
+
+    example = load_example("example_bkt_data.json")
+    header = "{:<38} {:>11} {:>12} {:>12} {:>10} {:>12}".format(
+        "benchmark", "items x con", "median us", "best us", "peak KB", "retained KB")
+    print(header + (" {:>9}".format("vs base") if baseline is not None else ""))
+
+    results = []
+    for exercises in parse_sizes(args.exercises):
+        for concepts in parse_sizes(args.concepts):
+            for name, function in bkt_benchmarks(example, exercises, concepts):
+                results.append(run_benchmark(name, function, args.repeat, exercises, concepts))
+                print_result(results[-1], baseline)
+
+    benchmarks = checker_benchmarks(load_example("_example_table_resp.json"))
+    if not args.no_subprocess:
+        benchmarks += subprocess_benchmarks()
+    for name, function in benchmarks:
+        results.append(run_benchmark(name, function, args.repeat))
+        print_result(results[-1], baseline)
+
+    commit, dirty = git_commit()
+    out = args.out or os.path.join(RESULTS_DIR, "{}{}.json".format(commit[:12], "-dirty" if dirty else ""))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as out_file:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "argv": sys.argv[1:],
+            "results": results,
+        }, out_file, indent=2)
+    print("saved {}".format(out))
+
+
+if __name__ == "__main__":
+    main()
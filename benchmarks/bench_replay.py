@@ -0,0 +1,91 @@
+"""
+Times re-estimating knowledge for a whole (synthetic) response log with app.replay against calling
+pknown_seq for each learner and concept, and checks that both give the same estimates.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_replay [--learners N] [--concepts N] [--responses N] [--loop-learners N]
+                                      [--processes N,N,...]
+
+--processes also times app.parallel_replay with each number of processes.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.bkt import pknown_seq, CONCEPT, IS_READ, INIT, TRANSFER, EID, UID, STEP, CORRECT, SLIP, GUESS
+from app.replay import replay, PK
+from app.parallel_replay import parallel_replay
+
+
+def synthetic_log(learners, concepts, responses, exercises_per_concept=20, seed=0):
+    """
+    Returns (df_opp, concept_params, item_params) for learners who each answer about responses
+    exercises, spread over concepts (read and write)
+    """
+    rng = np.random.RandomState(seed)
+    item_params = pd.DataFrame([
+        {EID: "c{}-{}-{}".format(concept, is_read, i), SLIP: rng.uniform(0.05, 0.3),
+         GUESS: rng.uniform(0.05, 0.3), CONCEPT: "c{}".format(concept), IS_READ: is_read}
+        for concept in range(concepts) for is_read in (True, False) for i in range(exercises_per_concept)])
+    concept_params = pd.DataFrame([
+        {CONCEPT: "c{}".format(concept), IS_READ: is_read, INIT: rng.uniform(0.1, 0.5),
+         TRANSFER: rng.uniform(0.05, 0.3)}
+        for concept in range(concepts) for is_read in (True, False)])
+
+    uids = np.repeat(["u{}".format(i) for i in range(learners)], responses)
+    eids = item_params[EID].values[rng.randint(0, len(item_params), len(uids))]
+    df_opp = pd.DataFrame({UID: uids, EID: eids, CORRECT: rng.random_sample(len(uids)) < 0.6})
+    # steps count each learner's responses within a concept (read or write)
+    sequence = df_opp[UID] + "/" + df_opp[EID].str.rsplit("-", n=1).str[0]
+    df_opp[STEP] = df_opp.groupby(sequence).cumcount() + 1
+    return df_opp, concept_params, item_params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--learners", type=int, default=2000)
+    parser.add_argument("--concepts", type=int, default=10)
+    parser.add_argument("--responses", type=int, default=200, help="responses per learner")
+    parser.add_argument("--loop-learners", type=int, default=5,
+                        help="learners to time pknown_seq on (it is too slow for all of them)")
+    parser.add_argument("--processes", default="", help="comma-separated process counts to time parallel_replay with")
+    args = parser.parse_args()
+
+    df_opp, concept_params, item_params = synthetic_log(args.learners, args.concepts, args.responses)
+    print("{} responses, {} learners, {} concepts".format(len(df_opp), args.learners, args.concepts))
+
+    start = time.perf_counter()
+    replayed = replay(df_opp, concept_params, item_params)
+    replay_time = time.perf_counter() - start
+    print("replay: {:.2f}s ({:.0f} responses/s)".format(replay_time, len(df_opp) / replay_time))
+
+    for processes in [int(n) for n in args.processes.split(",") if n]:
+        start = time.perf_counter()
+        parallel = parallel_replay(df_opp, concept_params, item_params, processes)
+        parallel_time = time.perf_counter() - start
+        identical = all(np.array_equal(parallel[column].values, replayed[column].values) for column in replayed.columns)
+        print("parallel_replay, {} processes: {:.2f}s ({:.1f}x, identical: {})".format(
+            processes, parallel_time, replay_time / parallel_time, identical))
+
+    loop_uids = df_opp[UID].unique()[:args.loop_learners]
+    start = time.perf_counter()
+    max_error = 0.0
+    for uid in loop_uids:
+        for concept in concept_params[CONCEPT].unique():
+            for is_read in (True, False):
+                pk = pknown_seq(uid, concept, df_opp, concept_params, item_params, is_read)
+                expected = replayed[(replayed[UID] == uid) & (replayed[CONCEPT] == concept) &
+                                    (replayed[IS_READ] == is_read)].sort_values(STEP)
+                if len(expected) > 0:
+                    max_error = max(max_error, np.abs(expected[PK].values - pk.values[1:]).max())
+    loop_time = time.perf_counter() - start
+    per_response = loop_time / len(df_opp[df_opp[UID].isin(loop_uids)])
+    print("pknown_seq: {:.2f}s for {} learners ({:.0f} responses/s, ~{:.0f}s for the whole log)".format(
+        loop_time, len(loop_uids), 1 / per_response, per_response * len(df_opp)))
+    print("max difference from replay: {}".format(max_error))
+
+
+if __name__ == "__main__":
+    main()
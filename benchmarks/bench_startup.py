@@ -0,0 +1,58 @@
+"""
+Measures how long a fresh web process takes to import the app and how much memory it uses, with
+the BKT stack (pandas, numpy) loaded at startup as it used to be, loaded lazily on the first /bkt
+request (the default), and left out entirely (CHECKER_ONLY=true).
+
+Each measurement is a new interpreter, so the numbers include everything a gunicorn worker pays
+before serving its first request.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_startup [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# run in a fresh interpreter; prints {"seconds": import time, "rss_kb": max resident memory}
+MEASURE = """
+import json, resource, time
+start = time.perf_counter()
+from app import app
+if {eager}:
+    import app.bkt, app.param_registry, app.learner_state
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+SCENARIOS = [
+    ("eager bkt imports", {}, True),
+    ("lazy (default)", {}, False),
+    ("CHECKER_ONLY=true", {"CHECKER_ONLY": "true"}, False),
+]
+
+
+def measure(env, eager):
+    output = subprocess.run([sys.executable, "-c", MEASURE.format(eager=eager)], env=dict(os.environ, **env),
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per scenario")
+    args = parser.parse_args()
+
+    print("{:<20} {:>14} {:>12}".format("startup", "import ms p50", "max RSS MB"))
+    for name, env, eager in SCENARIOS:
+        results = [measure(env, eager) for _ in range(args.runs)]
+        print("{:<20} {:>14.1f} {:>12.1f}".format(
+            name,
+            statistics.median(result["seconds"] for result in results) * 1000,
+            statistics.median(result["rss_kb"] for result in results) / 1024))
+
+
+if __name__ == "__main__":
+    main()
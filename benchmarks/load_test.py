@@ -0,0 +1,304 @@
+"""
+Load test: starts the app in a local gunicorn (Procfile) or uwsgi (Procfile_manual / uwsgi.ini)
+server, sends it a mix of /bkt, /checker/table and /checker/writeCode requests from --concurrency
+client threads, and reports throughput and p50/p95/p99 latency per endpoint. Use it to choose the
+number of server workers and the WORKER_POOL_SIZE / GRADING_* settings.
+
+Requests are built from example_data: /bkt from example_bkt_data.json with a random answered
+exercise, correctness, prior and target concept; /checker/table from _example_table_resp.json with
+each cell answered correctly or as in the example at random; /checker/writeCode with a short
+program that prints the right output, the wrong output or raises. Every writeCode submission is
+distinct unless --code-variants is set, so by default none are answered from the grading cache.
+
+Each client sends its next request as soon as the last one is answered (a closed loop), so the
+throughput at a concurrency is what the server sustains with that many requests in flight.
+
+Usage (from the repo root):
+    python -m benchmarks.load_test [--server gunicorn|uwsgi] [--workers N] [--concurrency N,N,...]
+                                   [--duration SECONDS] [--mix bkt=6,table=2,writeCode=2] [--out FILE]
+    python -m benchmarks.load_test --url http://host:port ...    (test a server that is already running)
+
+Environment variables of this process (e.g. WORKER_POOL_SIZE) are passed on to the server; add more
+with --env KEY=VALUE.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_DIR = os.path.join(REPO_DIR, "example_data")
+
+# server command line from the Procfile of each setup (the "web:" line)
+PROCFILES = {"gunicorn": "Procfile", "uwsgi": "Procfile_manual"}
+WORKERS_FLAGS = {"gunicorn": "--workers", "uwsgi": "--processes"}
+
+BKT = "bkt"
+TABLE = "table"
+WRITE_CODE = "writeCode"
+PATHS = {BKT: "/bkt", TABLE: "/checker/table", WRITE_CODE: "/checker/writeCode"}
+# checker-only route polled until the server answers
+READY_PATH = "/checker/cacheStats"
+READY_TIMEOUT = 60
+REQUEST_TIMEOUT = 60
+
+DEFAULT_MIX = "bkt=6,table=2,writeCode=2"
+
+# writeCode submissions: (user code, test code) with a number {n} filled in per submission, which
+# only changes what is printed
+PROGRAMS = [
+    ("total = {n}\nfor i in range(1000):\n    total += i\nprint(total)", "print({n} + sum(range(1000)))"),
+    ("print({n} * 2)", "print({n} * 2)"),
+    ("print({n} + 1)", "print({n} * 2)"), # wrong output
+    ("print({n} / 0)", "print({n})"), # error
+]
+
+
+def load_example(name):
+    with open(os.path.join(EXAMPLE_DIR, name)) as example_file:
+        return json.load(example_file)
+
+
+class RequestFactory:
+    """
+    Builds request bodies for each endpoint from example_data. Not thread safe: give each client
+    thread its own.
+    """
+
+    def __init__(self, seed, code_variants=0):
+        self.rng = random.Random(seed)
+        self.code_variants = code_variants
+        self.bkt = load_example("example_bkt_data.json")
+        self.table = load_example("_example_table_resp.json")
+
+    def body(self, endpoint):
+        return getattr(self, endpoint + "_body")()
+
+    def bkt_body(self):
+        body = dict(self.bkt)
+        body["exerciseID"] = self.rng.choice(body["exerciseIDs"])
+        body["isCorrect"] = self.rng.random() < 0.6
+        body["priorPknown"] = self.rng.uniform(0.05, 0.95)
+        body["targetConcept"] = self.rng.choice(body["conceptMap"]["concepts"])
+        return body
+
+    def table_body(self):
+        answers = [[answer if self.rng.random() < 0.5 else question["answer"]
+                    for question, answer in zip(questions, row)]
+                   for questions, row in zip(self.table["questions"], self.table["userAnswer"])]
+        return {"questions": self.table["questions"], "userAnswer": answers}
+
+    def writeCode_body(self):
+        if self.code_variants > 0:
+            n = self.rng.randrange(self.code_variants)
+        else:
+            n = self.rng.randrange(10 ** 9)
+        user_code, test_code = PROGRAMS[n % len(PROGRAMS)]
+        return {"userAnswer": user_code.format(n=n), "testCode": test_code.format(n=n)}
+
+
+def parse_mix(mix):
+    """
+    {endpoint: weight} from "endpoint=weight,..."
+    """
+    weights = {}
+    for item in mix.split(","):
+        endpoint, _, weight = item.partition("=")
+        if endpoint not in PATHS:
+            raise ValueError("Unknown endpoint {} (expected one of {})".format(endpoint, ", ".join(PATHS)))
+        weights[endpoint] = float(weight or 1)
+    return weights
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as err:
+        return err.code
+    except (urllib.error.URLError, OSError):
+        return None
+
+
+def run_clients(base_url, weights, concurrency, duration, code_variants, seed):
+    """
+    Sends requests from concurrency threads for duration seconds. Returns
+    ({endpoint: [(latency seconds, status or None)]}, elapsed seconds)
+    """
+    endpoints = list(weights)
+    samples = {endpoint: [] for endpoint in endpoints}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def client(index):
+        factory = RequestFactory(seed * 1000 + index, code_variants)
+        rng = random.Random(seed * 1000 + index)
+        local = []
+        while time.perf_counter() < deadline:
+            endpoint = rng.choices(endpoints, [weights[endpoint] for endpoint in endpoints])[0]
+            body = factory.body(endpoint)
+            sent = time.perf_counter()
+            status = post(base_url + PATHS[endpoint], body)
+            local.append((endpoint, time.perf_counter() - sent, status))
+        with lock:
+            for endpoint, latency, status in local:
+                samples[endpoint].append((latency, status))
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return float("nan")
+    rank = min(max(1, math.ceil(fraction * len(sorted_values))), len(sorted_values))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    """
+    Per endpoint (and "all"): requests, errors (no response or status >= 400), throughput and
+    latency percentiles in ms
+    """
+    summary = {}
+    everything = [sample for endpoint in samples for sample in samples[endpoint]]
+    for endpoint, endpoint_samples in list(samples.items()) + [("all", everything)]:
+        latencies = sorted(latency for latency, _ in endpoint_samples)
+        summary[endpoint] = {
+            "requests": len(endpoint_samples),
+            "errors": sum(1 for _, status in endpoint_samples if status is None or status >= 400),
+            "rps": len(endpoint_samples) / elapsed if elapsed > 0 else 0.0,
+            "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else float("nan"),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000 if latencies else float("nan"),
+        }
+    return summary
+
+
+def server_command(server, port, workers, command=None):
+    """
+    The server's command line from its Procfile (or command), bound to port
+    """
+    if command is None:
+        with open(os.path.join(REPO_DIR, PROCFILES[server])) as procfile:
+            web = [line for line in procfile if line.startswith("web:")][0]
+        command = web[len("web:"):].strip()
+    args = shlex.split(command)
+    if server == "gunicorn":
+        args += ["--bind", "127.0.0.1:{}".format(port)]
+    if workers:
+        args += [WORKERS_FLAGS[server], str(workers)]
+    return args
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(base_url, process):
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("Server exited with status {}".format(process.returncode))
+        try:
+            with urllib.request.urlopen(base_url + READY_PATH, timeout=1) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not answer {} within {}s".format(READY_PATH, READY_TIMEOUT))
+
+
+def print_summary(concurrency, summary):
+    print("\nconcurrency {}".format(concurrency))
+    print("{:<10} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "endpoint", "requests", "errors", "req/s", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for endpoint, stats in summary.items():
+        print("{:<10} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            endpoint, stats["requests"], stats["errors"], stats["rps"], stats["mean_ms"],
+            stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--server", choices=sorted(PROCFILES), default="gunicorn")
+    parser.add_argument("--command", default=None, help="server command line to use instead of the Procfile's")
+    parser.add_argument("--workers", type=int, default=None, help="server worker processes (default: the server's)")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE to set in the server's environment")
+    parser.add_argument("--url", default=None, help="test this running server instead of starting one")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated client thread counts")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to send requests for, per concurrency")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds of unrecorded requests first")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint=weight,... (endpoints: {})".format(", ".join(PATHS)))
+    parser.add_argument("--code-variants", type=int, default=0,
+                        help="distinct writeCode submissions to draw from (0: all distinct, so no grading cache hits)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    process = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        port = free_port()
+        base_url = "http://127.0.0.1:{}".format(port)
+        env = dict(os.environ, PORT=str(port))
+        env.update(item.split("=", 1) for item in args.env)
+        command = server_command(args.server, port, args.workers, args.command)
+        print("starting: {}".format(" ".join(command)))
+        process = subprocess.Popen(command, cwd=REPO_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    results = []
+    try:
+        wait_until_ready(base_url, process)
+        if args.warmup > 0:
+            run_clients(base_url, weights, 2, args.warmup, args.code_variants, args.seed + 1)
+        for concurrency in [int(value) for value in args.concurrency.split(",") if value]:
+            samples, elapsed = run_clients(base_url, weights, concurrency, args.duration,
+                                           args.code_variants, args.seed)
+            summary = summarize(samples, elapsed)
+            print_summary(concurrency, summary)
+            results.append({"concurrency": concurrency, "seconds": elapsed, "endpoints": summary})
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    if args.out:
+        with open(args.out, "w") as out_file:
+            json.dump({"server": "url" if args.url else args.server, "workers": args.workers, "mix": weights,
+                       "env": args.env, "code_variants": args.code_variants, "results": results},
+                      out_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Run from the repo root with `python -m pytest tests`.
+"""
+import secrets
+import time
+
+from app import execution
+
+SLEEP_SECONDS = 1.0
+PROGRAM = "import time\ntime.sleep({})\nprint('done')\n".format(SLEEP_SECONDS)
+
+
+def test_compare_with_reference_overlaps_runs_on_a_cache_miss():
+    # start the pool (if any) and look up the interpreter version before timing
+    execution.compare_with_reference("print(1)", "print(1)  # {}".format(secrets.token_hex(8)))
+
+    # a comment no other test uses, so the reference isn't cached
+    reference = PROGRAM + "# {}\n".format(secrets.token_hex(8))
+    start = time.perf_counter()
+    user_result, reference_result, mismatch = execution.compare_with_reference(PROGRAM, reference)
+    elapsed = time.perf_counter() - start
+
+    assert (user_result.returncode, reference_result.returncode, mismatch) == (0, 0, None)
+    # about max(user, reference), well short of their sum
+    assert SLEEP_SECONDS <= elapsed < 1.6 * SLEEP_SECONDS
+
+
+def test_compare_with_reference_uses_cached_reference():
+    reference = "print('a')\nprint('b')  # {}\n".format(secrets.token_hex(8))
+    first = execution.compare_with_reference("print('a')\nprint('b')", reference)
+    second = execution.compare_with_reference("print('a')\nprint('c')", reference)
+
+    assert first[2] is None
+    assert second[1].stdout == "a\nb\n"
+    assert second[2] == ("b", "c")
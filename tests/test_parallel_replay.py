@@ -0,0 +1,73 @@
+"""
+parallel_replay must give exactly what replay gives, whatever the number of processes.
+
+Run from the repo root with `python -m pytest tests`.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.bkt import CONCEPT, IS_READ, EID, UID, STEP, SLIP, GUESS
+from app.replay import replay
+from app.parallel_replay import parallel_replay
+from benchmarks.bench_replay import synthetic_log
+
+
+def shuffled_log(seed=0):
+    """
+    bench_replay's synthetic_log for a few learners, plus some responses to unknown exercises
+    (which replay drops), with the rows shuffled
+    """
+    df_opp, concept_params, item_params = synthetic_log(40, 3, 30, exercises_per_concept=5, seed=seed)
+    unknown = df_opp.sample(n=10, random_state=seed)
+    unknown[EID] = "unknown"
+    df_opp = pd.concat([df_opp, unknown], ignore_index=True)
+    return df_opp.sample(frac=1, random_state=seed), concept_params, item_params
+
+
+def assert_identical(result, expected):
+    assert list(result.columns) == list(expected.columns)
+    assert result.index.equals(expected.index)
+    for column in expected.columns:
+        assert np.array_equal(result[column].values, expected[column].values), column
+
+
+@pytest.mark.parametrize("processes", [1, 2, 3])
+def test_parallel_replay_matches_replay(processes):
+    df_opp, concept_params, item_params = shuffled_log()
+    expected = replay(df_opp, concept_params, item_params)
+
+    result = parallel_replay(df_opp, concept_params, item_params, processes=processes)
+
+    assert len(expected) == (df_opp[EID] != "unknown").sum()
+    assert_identical(result, expected)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parallel_replay_ignores_unused_concepts_without_params(processes):
+    df_opp, concept_params, item_params = shuffled_log()
+    # an item whose concept has no concept params, which no response is to
+    unused = pd.DataFrame([{EID: "unused-1", SLIP: 0.1, GUESS: 0.2, CONCEPT: "unused", IS_READ: True}])
+    item_params = pd.concat([item_params, unused], ignore_index=True)
+    expected = replay(df_opp, concept_params, item_params)
+
+    result = parallel_replay(df_opp, concept_params, item_params, processes=processes)
+
+    assert_identical(result, expected)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parallel_replay_raises_like_replay_on_broken_steps(processes):
+    df_opp, concept_params, item_params = shuffled_log()
+    # drop one learner's first response to a concept, so that sequence starts at step 2
+    first = df_opp[(df_opp[UID] == "u7") & (df_opp[STEP] == 1) & (df_opp[EID] != "unknown")].index[0]
+    df_opp = df_opp.drop(first)
+
+    with pytest.raises(Exception) as expected:
+        replay(df_opp, concept_params, item_params)
+    with pytest.raises(Exception) as raised:
+        parallel_replay(df_opp, concept_params, item_params, processes=processes)
+
+    assert "Did not find exactly 1 response for user u7" in str(expected.value)
+    assert type(raised.value) is type(expected.value)
+    assert str(raised.value) == str(expected.value)